@@ -1,17 +1,25 @@
-from typing import Annotated, List
-from fastapi import APIRouter, Depends, HTTPException, status, Form
+from typing import Annotated, List, Optional
+from fastapi import APIRouter, Depends, HTTPException, status, Form, Query, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
-from pydantic import BaseModel, Field, EmailStr
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
+from pydantic import BaseModel, Field, EmailStr, TypeAdapter
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import jwt, JWTError
 from datetime import datetime, timedelta, timezone
 import logging
 logging.basicConfig(level=logging.INFO)
 
-from models import Users
+from models import Users, byte_order, user_search_values
 from dependencies import get_db  
+from principals import Principal, principal_cache, bump_users_version, USER_COLUMNS
+from pagination import NEXT_CURSOR_HEADER, MAX_PAGE_SIZE, encode_cursor, decode_cursor
+from export import ExportFormat, MEDIA_TYPES, user_export_query, stream_export
+from passwords import PasswordHasherBusy, hash_password, verify_password
+from ratelimit import LOGIN_ACCOUNT_RATE, rate_limiter, rate_limited_exception
 import os
+import sys
 
 router = APIRouter(prefix="/auth", tags=["Authentication"])
 
@@ -22,7 +30,6 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 ALLOW_MAKE_ADMIN = os.getenv("ALLOW_MAKE_ADMIN", "false").lower() in ("1", "true", "yes")
 
-bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 # Custom form to use 'email' instead of 'username'
@@ -36,7 +43,7 @@ class LoginRequest(BaseModel):
     email: EmailStr
     password: str
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 # ----------------------------------------
 # Schemas
@@ -65,25 +72,41 @@ class UserResponse(BaseModel):
     class Config:
         from_attributes = True
 
+user_list_adapter = TypeAdapter(List[UserResponse])
+
+TOTAL_COUNT_HEADER = "X-Total-Count"
+
 # ----------------------------------------
 # Utilities
 # ----------------------------------------
 
-def authenticate_user(email: str, password: str, db: Session):
-    user = db.query(Users).filter(Users.email == email).first()
+async def authenticate_user(email: str, password: str, db: AsyncSession):
+    user = await db.scalar(select(Users).where(Users.email == email))
     if not user:
         return False
-    if not bcrypt_context.verify(password, user.hashed_password):
+    valid, new_hash = await verify_password(password, user.hashed_password)
+    if not valid:
         return False
+    if new_hash:
+        # Stored hash uses an outdated bcrypt cost; upgrade it transparently
+        user.hashed_password = new_hash
+        await db.commit()
     return user
 
+def password_hasher_busy_exception():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many login attempts in progress, please retry shortly",
+        headers={"Retry-After": "1"},
+    )
+
 def create_access_token(email: str):
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode = {"sub": email, "exp": expire}
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: db_dependency):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: db_dependency):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -97,51 +120,69 @@ def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: db_depen
     except JWTError:
         raise credentials_exception
 
-    user = db.query(Users).filter(Users.email == email).first()
-    if user is None:
-        raise credentials_exception
-    return user
+    version = await principal_cache.version(db)
+    principal = principal_cache.get(email)
+    if principal is None:
+        row = (await db.execute(
+            select(*USER_COLUMNS)
+            .where(Users.email == email)
+        )).first()
+        if row is None:
+            raise credentials_exception
+        principal = Principal(**row._mapping)
+        principal_cache.set(email, principal, version)
+    return principal
 
 # ----------------------------------------
 # Routes
 # ----------------------------------------
 
 @router.post("/register")
-def create_user(create_user_request: CreateUserRequest, db: db_dependency):
+async def create_user(create_user_request: CreateUserRequest, db: db_dependency):
     logging.info(f"Registration attempt: {create_user_request.email}, mobile: {create_user_request.mobile_no}")
-    existing_user = db.query(Users).filter(Users.email == create_user_request.email).first()
-    if existing_user:
-        logging.warning(f"Registration failed: Email already registered: {create_user_request.email}")
-        raise HTTPException(status_code=400, detail="User already registered")
-    existing_mobile = db.query(Users).filter(Users.mobile_no == create_user_request.mobile_no).first()
-    if existing_mobile:
-        logging.warning(f"Registration failed: Mobile number already registered: {create_user_request.mobile_no}")
-        raise HTTPException(status_code=400, detail="Mobile number already registered")
-    hashed_pw = bcrypt_context.hash(create_user_request.password)
     # Only allow admin if this is the first user
-    is_first_user = db.query(Users).count() == 0
-    is_admin = create_user_request.admin and is_first_user
-    if create_user_request.admin and not is_first_user:
+    if create_user_request.admin and await db.scalar(select(Users.id).limit(1)) is not None:
         logging.warning(f"Registration failed: Attempt to register admin after first user: {create_user_request.email}")
         raise HTTPException(status_code=403, detail="Admin can only be assigned to the first registered user.")
+    try:
+        hashed_pw = await hash_password(create_user_request.password)
+    except PasswordHasherBusy:
+        raise password_hasher_busy_exception()
     new_user = Users(
         email=create_user_request.email,
         first_name=create_user_request.first_name,
         last_name=create_user_request.last_name,
         mobile_no=create_user_request.mobile_no,
         hashed_password=hashed_pw,
-        admin=is_admin
+        admin=create_user_request.admin,
+        **user_search_values(create_user_request.email, create_user_request.first_name, create_user_request.last_name)
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    # Duplicates are rejected by the unique indexes on email and mobile_no
+    try:
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        if "mobile_no" in str(e.orig):
+            logging.warning(f"Registration failed: Mobile number already registered: {create_user_request.mobile_no}")
+            raise HTTPException(status_code=400, detail="Mobile number already registered")
+        logging.warning(f"Registration failed: Email already registered: {create_user_request.email}")
+        raise HTTPException(status_code=400, detail="User already registered")
     logging.info(f"User registered successfully: {new_user.email}, admin: {new_user.admin}")
     return {"message": "User registered successfully", "user_id": new_user.id}
 
 @router.post("/login", response_model=TokenResponse)
-def login(form_data: Annotated[OAuth2EmailRequestForm, Depends()], db: db_dependency):
+async def login(form_data: Annotated[OAuth2EmailRequestForm, Depends()], db: db_dependency):
     # Updated: Trigger Render redeployment for user deletion sync
-    user = authenticate_user(form_data.email, form_data.password, db)
+    # Per-account limit, on top of the per-IP one, against credential stuffing from many addresses
+    wait = await rate_limiter.take(LOGIN_ACCOUNT_RATE, form_data.email.lower())
+    if wait:
+        logging.warning(f"Login rate limited for account: {form_data.email}")
+        raise rate_limited_exception(wait)
+    try:
+        user = await authenticate_user(form_data.email, form_data.password, db)
+    except PasswordHasherBusy:
+        raise password_hasher_busy_exception()
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
@@ -149,12 +190,12 @@ def login(form_data: Annotated[OAuth2EmailRequestForm, Depends()], db: db_depend
     return {"access_token": token, "token_type": "bearer"}
 
 @router.post("/logout")
-def logout(): 
+async def logout(): 
     # For stateless JWT, logout is handled on the client by removing the token
     return {"message": "Logged out successfully. Please remove the token from your client."}
 
 @router.get("/me")
-def get_my_profile(current_user: Annotated[Users, Depends(get_current_user)]):
+async def get_my_profile(current_user: Annotated[Principal, Depends(get_current_user)]):
     return {
         "email": current_user.email,
         "name": f"{current_user.first_name} {current_user.last_name}",
@@ -163,13 +204,13 @@ def get_my_profile(current_user: Annotated[Users, Depends(get_current_user)]):
     }
 
 @router.get("/admin-only")
-def admin_only(current_user: Annotated[Users, Depends(get_current_user)]):
+async def admin_only(current_user: Annotated[Principal, Depends(get_current_user)]):
     if not current_user.admin:
         raise HTTPException(status_code=403, detail="Admins only")
     return {"message": f"Welcome Admin {current_user.first_name}!"}
 
 @router.post("/make-admin")
-def make_user_admin(email: str, db: db_dependency):
+async def make_user_admin(email: str, db: db_dependency):
     """
     Elevate a user to admin by their email.
     Guarded by ALLOW_MAKE_ADMIN env flag. Keep disabled in production.
@@ -177,12 +218,14 @@ def make_user_admin(email: str, db: db_dependency):
     if not ALLOW_MAKE_ADMIN:
         raise HTTPException(status_code=403, detail="This endpoint is disabled in this environment")
 
-    user = db.query(Users).filter(Users.email == email).first()
+    user = await db.scalar(select(Users).where(Users.email == email))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     user.admin = True
-    db.commit()
+    await db.run_sync(bump_users_version)
+    await db.commit()
+    principal_cache.invalidate()
     
     return {
         "message": f"User {email} is now an admin",
@@ -190,13 +233,87 @@ def make_user_admin(email: str, db: db_dependency):
         "admin": user.admin
     }
 
+def _prefix_match(expression, prefix: str):
+    # A range instead of LIKE, so a plain B-tree index on `expression` is used.
+    # Only a prefix test in byte order, hence byte_order() here and in the
+    # indexes (models.py).
+    expression = byte_order(expression)
+    # Trailing U+10FFFF cannot be incremented; every string starting with the
+    # rest sorts below the incremented rest anyway
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return expression >= prefix
+    next_char = ord(stem[-1]) + 1
+    if 0xD800 <= next_char <= 0xDFFF:
+        # Surrogates are not valid text; the next character is U+E000
+        next_char = 0xE000
+    return and_(expression >= prefix, expression < stem[:-1] + chr(next_char))
+
 @router.get("/users", response_model=List[UserResponse])
-def get_all_users(current_user: Annotated[Users, Depends(get_current_user)], db: db_dependency):
+async def get_all_users(
+    current_user: Annotated[Principal, Depends(get_current_user)],
+    db: db_dependency,
+    limit: Annotated[Optional[int], Query(ge=1, le=MAX_PAGE_SIZE)] = None,
+    cursor: Optional[str] = None,
+    q: Annotated[Optional[str], Query(min_length=1, max_length=100)] = None,
+    include_total: bool = False,
+):
     """
-    Get all users - Admin only endpoint
+    Get all users - Admin only endpoint.
+    Pass `limit` to page through users by id; the cursor for the next page is
+    returned in the X-Next-Cursor header. `q` matches the start of the email,
+    first name, last name (case-insensitive) or mobile number.
+    `include_total` adds an X-Total-Count header to unfiltered listings,
+    counted on request.
     """
     if not current_user.admin:
         raise HTTPException(status_code=403, detail="Only admins can view all users")
-    
-    users = db.query(Users).all()
-    return users
+
+    query = select(*USER_COLUMNS)
+    if q:
+        # Lowercased like the stored search columns (user_search_values)
+        lowered = q.lower()
+        query = query.where(or_(
+            _prefix_match(Users.email_lower, lowered),
+            _prefix_match(Users.first_name_lower, lowered),
+            _prefix_match(Users.last_name_lower, lowered),
+            _prefix_match(Users.mobile_no, q),
+        ))
+    if cursor:
+        (after_id,) = decode_cursor(cursor, 1)
+        if not isinstance(after_id, int):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(Users.id > after_id)
+
+    query = query.order_by(Users.id)
+    headers = {}
+    if limit is not None:
+        # Fetch one extra row to know whether another page exists
+        rows = (await db.execute(query.limit(limit + 1))).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1].id)
+    else:
+        rows = (await db.execute(query)).all()
+    if include_total and not q:
+        headers[TOTAL_COUNT_HEADER] = str(await db.scalar(select(func.count()).select_from(Users)))
+
+    body = user_list_adapter.dump_json(user_list_adapter.validate_python(rows, from_attributes=True))
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@router.get("/users/export", response_class=StreamingResponse)
+async def export_users(
+    current_user: Annotated[Principal, Depends(get_current_user)],
+    format: ExportFormat = ExportFormat.ndjson,
+):
+    """
+    Stream every user (without password hashes) as NDJSON or CSV - Admin only
+    """
+    if not current_user.admin:
+        raise HTTPException(status_code=403, detail="Only admins can export users")
+    return StreamingResponse(
+        stream_export(user_export_query(), format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="users-{datetime.now().date().isoformat()}.{format.value}"'},
+    )
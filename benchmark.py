@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Load and latency benchmark for the API.
+
+Runs the app against a throw-away SQLite database, seeds users and notices,
+then drives a weighted mix of requests at one or more concurrency levels and
+reports throughput and p50/p95/p99 latency as JSON.
+
+The app runs in-process over ASGI by default, or as a real uvicorn server
+with --server uvicorn. Requires httpx (pip install httpx).
+
+Usage:
+    python benchmark.py
+    python benchmark.py --users 1000 --notices 20000 --concurrency 1,10,50 --requests 3000
+    python benchmark.py --mix list=60,get=30,login=5,write=5 --output results.json
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json   # exits 1 on regression
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+OPERATIONS = ("list", "list_page", "get", "login", "write")
+DEFAULT_MIX = "list=55,list_page=15,get=20,login=5,write=5"
+BENCHMARK_PASSWORD = "benchmark-password"
+USER_PREFIX = "bench"
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise SystemExit(f"Unknown operation '{name}' in --mix; choose from {', '.join(OPERATIONS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list) -> dict:
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def seed(users: int, notices: int, seed_value: int):
+    """
+    Bulk-load synthetic users (all sharing BENCHMARK_PASSWORD, user0 is the
+    admin) and notices across all types; returns the notice ids
+    """
+    from sqlalchemy import select
+    from bulk_data import generate_notices, generate_users, load_rows
+    from db import Sessionlocal
+    from models import Notice, Users
+
+    load_rows(Users, generate_users(users, BENCHMARK_PASSWORD, prefix=USER_PREFIX))
+    load_rows(Notice, generate_notices(notices, seed_value))
+    with Sessionlocal() as db:
+        return list(db.scalars(select(Notice.id)))
+
+
+class Runner:
+    def __init__(self, client, weights: dict, notice_ids: list, users: int, admin_token: str, rng: random.Random):
+        self.client = client
+        self.operations = list(weights)
+        self.weights = [weights[name] for name in self.operations]
+        self.notice_ids = notice_ids
+        self.users = users
+        self.admin_headers = {"Authorization": f"Bearer {admin_token}"}
+        self.rng = rng
+
+    async def request(self, operation: str):
+        if operation == "list":
+            return await self.client.get("/notice/")
+        if operation == "list_page":
+            return await self.client.get("/notice/", params={"limit": 20})
+        if operation == "get":
+            return await self.client.get(f"/notice/{self.rng.choice(self.notice_ids)}")
+        if operation == "login":
+            email = f"{USER_PREFIX}{self.rng.randrange(self.users)}@example.com"
+            return await self.client.post("/auth/login", data={"email": email, "password": BENCHMARK_PASSWORD})
+        if operation == "write":
+            return await self.client.post("/notice/", headers=self.admin_headers, json={
+                "title": "Benchmark write",
+                "description": "Notice created during the benchmark run",
+                "type": "Other",
+            })
+        raise ValueError(operation)
+
+    async def run_level(self, concurrency: int, total_requests: int) -> dict:
+        plan = self.rng.choices(self.operations, weights=self.weights, k=total_requests)
+        latencies = {name: [] for name in self.operations}
+        errors = {name: 0 for name in self.operations}
+        position = 0
+
+        async def worker():
+            nonlocal position
+            while position < len(plan):
+                operation = plan[position]
+                position += 1
+                started = time.perf_counter()
+                try:
+                    response = await self.request(operation)
+                    failed = response.status_code >= 400
+                except Exception:
+                    failed = True
+                latencies[operation].append(time.perf_counter() - started)
+                if failed:
+                    errors[operation] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+        all_latencies = [value for values in latencies.values() for value in values]
+        return {
+            "concurrency": concurrency,
+            "requests": total_requests,
+            "errors": sum(errors.values()),
+            "elapsed_s": round(elapsed, 3),
+            "throughput_rps": round(total_requests / elapsed, 1),
+            "latency": summarize(all_latencies),
+            "operations": {
+                name: dict(summarize(latencies[name]), errors=errors[name])
+                for name in self.operations if latencies[name]
+            },
+        }
+
+
+async def benchmark(args, client_factory) -> dict:
+    rng = random.Random(args.seed)
+    notice_ids = seed(args.users, args.notices, args.seed)
+    weights = parse_mix(args.mix)
+
+    async with client_factory() as client:
+        response = await client.post("/auth/login", data={"email": f"{USER_PREFIX}0@example.com", "password": BENCHMARK_PASSWORD})
+        response.raise_for_status()
+        runner = Runner(client, weights, notice_ids, args.users, response.json()["access_token"], rng)
+
+        # Warm caches, pools and the password hashing processes
+        await runner.run_level(min(4, max(args.concurrency)), args.warmup)
+
+        results = []
+        for concurrency in args.concurrency:
+            result = await runner.run_level(concurrency, args.requests)
+            print(f"concurrency={concurrency:<4} rps={result['throughput_rps']:<8} "
+                  f"p50={result['latency']['p50_ms']}ms p95={result['latency']['p95_ms']}ms "
+                  f"p99={result['latency']['p99_ms']}ms errors={result['errors']}", file=sys.stderr)
+            results.append(result)
+
+    return {
+        "config": {
+            "server": args.server,
+            "users": args.users,
+            "notices": args.notices,
+            "requests": args.requests,
+            "mix": weights,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+async def run_in_process(args) -> dict:
+    import httpx
+    from main import app
+
+    # The lifespan also disposes the engines, so aiosqlite's threads exit
+    async with app.router.lifespan_context(app):
+        return await benchmark(args, lambda: httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://benchmark"
+        ))
+
+
+async def run_uvicorn(args) -> dict:
+    import httpx
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        env=os.environ.copy(),
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        async with httpx.AsyncClient(base_url=base_url) as client:
+            for _ in range(100):
+                try:
+                    if (await client.get("/health")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise SystemExit("uvicorn did not become healthy")
+        limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+        return await benchmark(args, lambda: httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60))
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Regressions of p95 latency or throughput beyond `tolerance` (0.2 = 20%)
+    at the concurrency levels both runs share
+    """
+    regressions = []
+    previous = {result["concurrency"]: result for result in baseline.get("results", [])}
+    for result in report["results"]:
+        before = previous.get(result["concurrency"])
+        if not before:
+            continue
+        if result["latency"]["p95_ms"] > before["latency"]["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"concurrency={result['concurrency']}: p95 {before['latency']['p95_ms']}ms -> {result['latency']['p95_ms']}ms"
+            )
+        if result["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"concurrency={result['concurrency']}: throughput {before['throughput_rps']} -> {result['throughput_rps']} rps"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the notice board API")
+    parser.add_argument("--server", choices=["asgi", "uvicorn"], default="asgi",
+                        help="run the app in-process over ASGI or as a uvicorn subprocess")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--notices", type=int, default=2000)
+    parser.add_argument("--concurrency", type=lambda v: [int(c) for c in v.split(",")], default=[1, 10, 50],
+                        help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights, default {DEFAULT_MIX}")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="compare against this stored report")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression ratio vs the baseline")
+    parser.add_argument("--save-baseline", help="store this run as the new baseline")
+    args = parser.parse_args()
+
+    try:
+        import httpx  # noqa: F401
+    except ImportError:
+        raise SystemExit("benchmark.py needs httpx: pip install httpx")
+
+    # One log line per client request would dominate the output
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix="noticeboard-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+    os.environ.setdefault("LEADER_LOCK_DIR", workdir)
+    # Every simulated client shares one IP and one account: rate limits and
+    # load shedding would answer with fast 429s/503s and skew the latencies
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+    os.environ["LOAD_SHED_MAX_IN_FLIGHT"] = "0"
+    os.environ["LOAD_SHED_MAX_THREADPOOL_QUEUE"] = "0"
+
+    # Keep stdout for the JSON report; the app prints its startup messages
+    with contextlib.redirect_stdout(sys.stderr):
+        # Create the schema before seeding, exactly as the app does on startup
+        from main import prepare_database
+        prepare_database()
+
+        runner = run_uvicorn if args.server == "uvicorn" else run_in_process
+        report = asyncio.run(runner(args))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("❌ Performance regressions against baseline:", file=sys.stderr)
+            for regression in regressions:
+                print(f"   {regression}", file=sys.stderr)
+            sys.exit(1)
+        print("✅ No regressions against baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Bulk data tool: load users and notices from CSV/NDJSON, generate synthetic
+data, or empty the tables quickly.
+
+Everything runs in one transaction. Postgres loads through COPY; other
+databases use batched executemany INSERTs, with SQLite's fsyncs switched off
+and the full-text index filled in one pass for the duration of the load.
+Files written by export_data.py load as is.
+
+Usage:
+    python bulk_data.py load notices notices.csv
+    python bulk_data.py load users users.ndjson
+    python bulk_data.py generate --users 100000 --notices 1000000
+    python bulk_data.py truncate --yes
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import sys
+import time as clock
+from datetime import date, time, timedelta
+from itertools import islice
+from typing import Iterable, Iterator, List
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.orm import Session
+
+from changes import record_notice_creation, reset_changes
+from db import SQLITE_SYNCHRONOUS, Sessionlocal
+from models import Notice, NoticeType, Users, user_search_values
+from passwords import bcrypt_context
+from principals import bump_users_version
+from search import SQLITE_FTS_DELETE_TRIGGER, SQLITE_FTS_INSERT_TRIGGER
+
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "10000"))
+
+# Column name -> parser for values read from CSV (strings) or NDJSON
+NOTICE_FIELDS = {
+    "id": int,
+    "title": str,
+    "description": str,
+    "post_date": date.fromisoformat,
+    "event_date": date.fromisoformat,
+    "event_start_time": time.fromisoformat,
+    "event_end_time": time.fromisoformat,
+    "type": str,
+}
+USER_FIELDS = {
+    "id": int,
+    "email": str,
+    "first_name": str,
+    "last_name": str,
+    "mobile_no": str,
+    "hashed_password": str,
+    "admin": lambda value: value if isinstance(value, bool) else str(value).lower() in ("1", "true", "yes"),
+}
+
+
+# ----------------------------------------
+# Reading
+# ----------------------------------------
+
+def read_records(path: str) -> Iterator[dict]:
+    """
+    Records from a .csv file, or NDJSON (one JSON object per line) otherwise
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _parse(record: dict, fields: dict, columns: List[str]) -> dict:
+    row = {}
+    for column in columns:
+        value = record.get(column)
+        row[column] = None if value is None or value == "" else fields[column](value)
+    return row
+
+
+def notice_rows(records: Iterable[dict]) -> Iterator[dict]:
+    columns = None
+    for record in records:
+        if columns is None:
+            # Keep ids only if the file has them (e.g. a restore from an export)
+            columns = [c for c in NOTICE_FIELDS if c != "id" or "id" in record]
+        row = _parse(record, NOTICE_FIELDS, columns)
+        row["post_date"] = row["post_date"] or date.today()
+        yield row
+
+
+def user_rows(records: Iterable[dict]) -> Iterator[dict]:
+    columns = None
+    hashes = {}
+    for record in records:
+        if columns is None:
+            columns = [c for c in USER_FIELDS if c != "id" or "id" in record]
+        row = _parse(record, USER_FIELDS, columns)
+        if row["hashed_password"] is None:
+            password = record.get("password")
+            if not password:
+                raise ValueError(f"User {row['email']} has neither hashed_password nor password")
+            # bcrypt is deliberately slow: hash each distinct password once
+            if password not in hashes:
+                hashes[password] = bcrypt_context.hash(password)
+            row["hashed_password"] = hashes[password]
+        row["admin"] = bool(row["admin"])
+        yield row
+
+
+# ----------------------------------------
+# Synthetic data
+# ----------------------------------------
+
+def generate_users(count: int, password: str = "password123", prefix: str = "user", admins: int = 1,
+                   start: int = 0) -> Iterator[dict]:
+    """
+    Users numbered from `start` (see next_user_number); the first `admins`
+    of them are admins
+    """
+    hashed = bcrypt_context.hash(password)
+    for i in range(count):
+        n = start + i
+        email, first_name, last_name = f"{prefix}{n}@example.com", f"First{n}", f"Last{n}"
+        yield {
+            "email": email,
+            "first_name": first_name,
+            "last_name": last_name,
+            "mobile_no": f"9{n:09d}",
+            "hashed_password": hashed,
+            "admin": i < admins,
+            **user_search_values(email, first_name, last_name),
+        }
+
+
+def next_user_number() -> int:
+    """
+    First number free for generated users: past the highest user id and the
+    highest generated-style mobile number (9 followed by the number), so
+    emails and mobile numbers stay unique when generating more users later.
+    0 means the users table is empty.
+    """
+    with Sessionlocal() as db:
+        max_id = db.scalar(select(func.max(Users.id))) or 0
+        # Longest first, then highest: numeric order for strings of digits
+        mobiles = db.scalars(
+            select(Users.mobile_no)
+            .where(Users.mobile_no.like("9%"), func.length(Users.mobile_no) >= 10)
+            .order_by(func.length(Users.mobile_no).desc(), Users.mobile_no.desc())
+            .limit(100)
+        )
+        max_mobile = next((mobile for mobile in mobiles if mobile.isdigit()), None)
+    return max(max_id, int(max_mobile[1:]) + 1 if max_mobile else 0)
+
+
+def generate_notices(count: int, seed: int = 0) -> Iterator[dict]:
+    """
+    Notices spread evenly over every NoticeType, posted during the last 90
+    days; two thirds have an upcoming event
+    """
+    rng = random.Random(seed)
+    types = [notice_type.value for notice_type in NoticeType]
+    today = date.today()
+    for i in range(count):
+        has_event = i % 3 != 0
+        start = time(rng.randint(8, 18), rng.choice((0, 30))) if has_event else None
+        yield {
+            "title": f"{types[i % len(types)]} notice {i}",
+            "description": f"Synthetic notice {i} generated for load testing. Residents please take note.",
+            "post_date": today - timedelta(days=rng.randint(0, 90)),
+            "event_date": today + timedelta(days=rng.randint(0, 120)) if has_event else None,
+            "event_start_time": start,
+            "event_end_time": time(start.hour + 1, start.minute) if start else None,
+            "type": types[i % len(types)],
+        }
+
+
+# ----------------------------------------
+# Loading
+# ----------------------------------------
+
+def _batches(rows: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _copy_batch(db: Session, table: str, batch: List[dict]):
+    columns = list(batch[0])
+    buffer = io.StringIO()
+    # Non-numeric values are quoted, so only None becomes an unquoted empty field, i.e. NULL
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for row in batch:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+    cursor = db.connection().connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+
+
+def _sqlite_bulk_pragmas(db: Session, enable: bool):
+    if enable:
+        db.execute(text("PRAGMA synchronous=OFF"))
+        db.execute(text("PRAGMA temp_store=MEMORY"))
+    else:
+        db.execute(text(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}"))
+        db.execute(text("PRAGMA temp_store=DEFAULT"))
+
+
+def load_rows(model, rows: Iterable[dict], batch_size: int = BULK_BATCH_SIZE) -> int:
+    """
+    Insert `rows` into `model`'s table in a single transaction and update the
+    counters the API caches depend on. Returns the number of rows inserted.
+    """
+    table = model.__tablename__
+    total = 0
+    with_ids = False
+    started = clock.perf_counter()
+    with Sessionlocal() as db:
+        dialect = db.get_bind().dialect.name
+        # Index the new notices for search in one statement at the end
+        # instead of through the per-row trigger
+        suspend_fts = model is Notice and dialect == "sqlite" and inspect(db.connection()).has_table("notice_fts")
+        if dialect == "sqlite":
+            _sqlite_bulk_pragmas(db, True)
+        if suspend_fts:
+            max_id_before = db.scalar(select(func.max(Notice.id))) or 0
+            db.execute(text("DROP TRIGGER IF EXISTS notice_fts_ai"))
+        try:
+            if model is Notice:
+                # One change sequence for the whole load, for delta sync
+                change = record_notice_creation(db)
+                rows = (dict(row, **change) for row in rows)
+            for batch in _batches(rows, batch_size):
+                with_ids = with_ids or "id" in batch[0]
+                if dialect == "postgresql":
+                    _copy_batch(db, table, batch)
+                else:
+                    # Core INSERT on the Table: one executemany per batch, where the
+                    # ORM bulk path would split batches on rows' NULL patterns
+                    db.execute(model.__table__.insert(), batch)
+                total += len(batch)
+                print(f"  {table}: {total} rows ({total / (clock.perf_counter() - started):.0f}/s)", file=sys.stderr)
+
+            if dialect == "postgresql" and with_ids:
+                # Explicit ids bypass the sequence; move it past them
+                db.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 1)) FROM {table}"
+                ))
+            if suspend_fts:
+                if with_ids:
+                    db.execute(text("INSERT INTO notice_fts(notice_fts) VALUES ('rebuild')"))
+                else:
+                    db.execute(text(
+                        "INSERT INTO notice_fts(rowid, title, description) "
+                        "SELECT id, title, description FROM notice WHERE id > :after"
+                    ), {"after": max_id_before})
+                db.execute(text(SQLITE_FTS_INSERT_TRIGGER))
+            if model is not Notice:
+                bump_users_version(db)
+            db.commit()
+        except Exception:
+            db.rollback()
+            if suspend_fts:
+                db.execute(text(SQLITE_FTS_INSERT_TRIGGER))
+                db.commit()
+            raise
+        finally:
+            if dialect == "sqlite":
+                _sqlite_bulk_pragmas(db, False)
+    return total
+
+
+def truncate_tables():
+    """
+    Remove every notice (live, archived and tombstoned) and user without
+    per-row work: TRUNCATE on Postgres, which restarts their id sequences;
+    on SQLite the per-row full-text trigger is dropped around the DELETE and
+    the search index is emptied in one go
+    """
+    with Sessionlocal() as db:
+        dialect = db.get_bind().dialect.name
+        if dialect == "postgresql":
+            db.execute(text("TRUNCATE notice, notice_archive, notice_tombstones, users RESTART IDENTITY"))
+        else:
+            has_fts = dialect == "sqlite" and inspect(db.connection()).has_table("notice_fts")
+            if has_fts:
+                db.execute(text("DROP TRIGGER IF EXISTS notice_fts_ad"))
+            try:
+                db.execute(text("DELETE FROM notice"))
+                db.execute(text("DELETE FROM notice_archive"))
+                db.execute(text("DELETE FROM notice_tombstones"))
+                db.execute(text("DELETE FROM users"))
+                if has_fts:
+                    db.execute(text("INSERT INTO notice_fts(notice_fts) VALUES ('delete-all')"))
+            finally:
+                if has_fts:
+                    db.execute(text(SQLITE_FTS_DELETE_TRIGGER))
+        # Removed without tombstones: delta sync clients reload the board
+        reset_changes(db)
+        bump_users_version(db)
+        db.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load, generate or truncate notice board data")
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load = commands.add_parser("load", help="load a CSV or NDJSON file")
+    load.add_argument("table", choices=["notices", "users"])
+    load.add_argument("path", help=".csv file, anything else is read as NDJSON")
+
+    generate = commands.add_parser("generate", help="insert synthetic users and notices")
+    generate.add_argument("--users", type=int, default=0)
+    generate.add_argument("--notices", type=int, default=0)
+    generate.add_argument("--password", default="password123", help="password shared by all generated users")
+    generate.add_argument("--prefix", default="user", help="email prefix; numbering continues after existing users")
+    generate.add_argument("--seed", type=int, default=0)
+
+    truncate = commands.add_parser("truncate", help="delete all users and notices")
+    truncate.add_argument("--yes", action="store_true", help="do not ask for confirmation")
+
+    args = parser.parse_args()
+    started = clock.perf_counter()
+
+    if args.command == "load":
+        records = read_records(args.path)
+        if args.table == "notices":
+            count = load_rows(Notice, notice_rows(records), args.batch_size)
+        else:
+            count = load_rows(Users, user_rows(records), args.batch_size)
+        print(f"✅ Loaded {count} {args.table} in {clock.perf_counter() - started:.1f}s")
+    elif args.command == "generate":
+        if args.users:
+            start = next_user_number()
+            # Only a fresh users table gets an admin
+            admins = 1 if start == 0 else 0
+            load_rows(Users, generate_users(args.users, args.password, args.prefix, admins, start), args.batch_size)
+        if args.notices:
+            load_rows(Notice, generate_notices(args.notices, args.seed), args.batch_size)
+        print(f"✅ Generated {args.users} users and {args.notices} notices in {clock.perf_counter() - started:.1f}s")
+    elif args.command == "truncate":
+        if not args.yes:
+            print("⚠️  WARNING: This will delete ALL records from users and notice tables!")
+            if input("Type 'YES' to confirm: ") != "YES":
+                print("❌ Operation cancelled")
+                sys.exit(1)
+        truncate_tables()
+        print("✅ Tables truncated")
@@ -0,0 +1,101 @@
+"""
+Versioned read-through caches for serialized notice responses and principals.
+
+Each worker keeps its own bounded cache of response bodies. Entries are only
+valid for one value of the ``notice_version`` counter; every notice write bumps
+that counter in the same transaction, so all workers drop their entries once
+they notice the new version. Workers re-read the counter at most once every
+``CACHE_VERSION_TTL`` seconds, which bounds how stale another worker can be
+while letting conditional requests (If-None-Match) be answered without any
+database round-trip in between.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from counters import bump_counter, get_counter, raise_counter
+
+NOTICE_VERSION = "notice_version"
+# Unix time of the last notice change, for Last-Modified
+NOTICE_LAST_MODIFIED = "notice_last_modified"
+
+CACHE_VERSION_TTL = float(os.getenv("CACHE_VERSION_TTL", "1.0"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+
+
+class VersionedCache:
+    def __init__(self, counter_name: str, max_entries: int = CACHE_MAX_ENTRIES,
+                 version_ttl: float = CACHE_VERSION_TTL, entry_ttl: Optional[float] = None):
+        self.counter_name = counter_name
+        self.max_entries = max_entries
+        self.version_ttl = version_ttl
+        # Optional upper bound on the age of a single entry, on top of versioning
+        self.entry_ttl = entry_ttl
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    async def version(self, db: AsyncSession) -> int:
+        """
+        Current version, read from the database only when the local copy is
+        older than version_ttl
+        """
+        now = time.monotonic()
+        if self._version is None or now - self._checked_at >= self.version_ttl:
+            version = await db.run_sync(get_counter, self.counter_name)
+            with self._lock:
+                if version != self._version:
+                    self._entries.clear()
+                    self._version = version
+                self._checked_at = now
+        return self._version
+
+    def get(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, version: int):
+        with self._lock:
+            # Drop results computed against a version that changed meanwhile
+            if version != self._version:
+                return
+            expires_at = time.monotonic() + self.entry_ttl if self.entry_ttl else None
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """
+        Forget local entries after a write; the next read re-reads the version
+        """
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+
+notice_cache = VersionedCache(NOTICE_VERSION)
+
+
+def bump_notice_version(db: Session) -> int:
+    """
+    Record a notice change in the current transaction and return the new
+    version. Call notice_cache.invalidate() once it has committed.
+    """
+    version = bump_counter(db, NOTICE_VERSION)
+    raise_counter(db, NOTICE_LAST_MODIFIED, int(time.time()))
+    return version
@@ -0,0 +1,252 @@
+"""
+Change tracking for delta sync (GET /notice/changes).
+
+Every transaction that writes notices bumps the notice version once and
+stamps the rows it inserts or updates with that version as ``change_seq``;
+deleted and expired notices leave a tombstone with the same sequence. The
+version's counter row stays locked until commit, so sequences become visible
+in order and a client that has seen everything up to N only needs the rows
+and tombstones above N.
+
+Tombstones are pruned after ``NOTICE_TOMBSTONE_RETENTION_DAYS``. The highest
+pruned sequence becomes the ``notice_changes_floor`` counter: a client whose
+cursor is below it has missed deletions and has to reload the whole board.
+Truncating the tables raises the floor in the same way.
+
+The same log feeds the live feed across workers: ``relay_notice_changes``
+polls it every ``EVENT_RELAY_SECONDS`` and publishes the changes other
+processes made (other gunicorn workers, the expiry leader, bulk_data.py) to
+this worker's hub, and ``subscribe_since`` replays it to a live feed client
+reconnecting with Last-Event-ID, whichever worker it reaches. Rows created by
+a change carry its sequence as ``created_seq`` as well, so a change is sent as
+the event its own process published: ``created``/``bulk_created``,
+``updated``/``bulk_updated``, ``deleted``/``bulk_deleted`` or ``expired``
+(``reset`` when there are too many to replay or the tables were truncated).
+A change whose rows were all written again later is sent with the later one.
+"""
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from cache import NOTICE_VERSION, bump_notice_version, notice_cache
+from counters import get_counter, raise_counter
+from db import AsyncSessionlocal, Sessionlocal
+from events import BroadcastHub, Subscriber
+from metrics import background_job_duration_seconds, background_job_failures_total, current_route
+from models import Notice, NoticeTombstone
+from serialization import NOTICE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+NOTICE_CHANGES_FLOOR = "notice_changes_floor"
+
+# Days deletions stay visible to delta sync; 0 keeps tombstones forever
+NOTICE_TOMBSTONE_RETENTION_DAYS = int(os.getenv("NOTICE_TOMBSTONE_RETENTION_DAYS", "30"))
+# Seconds between polls for changes made by other processes; 0 disables the relay
+EVENT_RELAY_SECONDS = float(os.getenv("EVENT_RELAY_SECONDS", "1"))
+
+
+def record_notice_change(db: Session) -> dict:
+    """
+    Bump the notice version for the current transaction and return the
+    ``change_seq``/``updated_at`` values to stamp on the rows it writes
+    """
+    return {"change_seq": bump_notice_version(db), "updated_at": datetime.now(timezone.utc)}
+
+
+def record_notice_creation(db: Session) -> dict:
+    """
+    record_notice_change() for a transaction inserting notices
+    """
+    change = record_notice_change(db)
+    return dict(change, created_seq=change["change_seq"])
+
+
+def add_tombstones(db: Session, notice_ids: Iterable[int], change: dict, reason: str):
+    """
+    Record deleted notices in the current transaction; `change` comes from
+    record_notice_change()
+    """
+    rows = [
+        {"notice_id": notice_id, "change_seq": change["change_seq"], "deleted_at": change["updated_at"], "reason": reason}
+        for notice_id in notice_ids
+    ]
+    if rows:
+        db.execute(insert(NoticeTombstone), rows)
+
+
+def reset_changes(db: Session):
+    """
+    Record a notice change that every client has to reload the board for,
+    such as notices removed without tombstones (truncate)
+    """
+    raise_counter(db, NOTICE_CHANGES_FLOOR, bump_notice_version(db))
+
+
+def purge_tombstones(retention_days: int = NOTICE_TOMBSTONE_RETENTION_DAYS) -> int:
+    """
+    Drop tombstones older than the retention period and raise the floor
+    past them
+    """
+    if retention_days <= 0:
+        return 0
+    current_route.set("job:notice_tombstone_retention")
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    with background_job_duration_seconds.time("notice_tombstone_retention"):
+        db = Sessionlocal()
+        try:
+            floor = db.scalar(select(func.max(NoticeTombstone.change_seq)).where(NoticeTombstone.deleted_at < cutoff))
+            if floor is None:
+                return 0
+            # Whole sequences only: a client is either before or after all of a change
+            count = db.execute(delete(NoticeTombstone).where(NoticeTombstone.change_seq <= floor)).rowcount
+            raise_counter(db, NOTICE_CHANGES_FLOOR, floor)
+            db.commit()
+            logger.info(f"Pruned {count} notice tombstones up to change {floor}")
+            return count
+        except Exception as e:
+            db.rollback()
+            background_job_failures_total.labels("notice_tombstone_retention").inc()
+            logger.error(f"Error pruning notice tombstones: {e}")
+            return 0
+        finally:
+            db.close()
+
+
+async def _change_events(db: AsyncSession, since: int, version: int, limit: int,
+                         skip: Callable[[int], bool] = lambda change_seq: False) -> Optional[List[Tuple[int, str, dict]]]:
+    """
+    (change_seq, event_type, data) for the changes after `since` up to
+    `version`, oldest first, leaving out those `skip` returns true for.
+    None when the client has to reload instead: the deletions it missed were
+    pruned, or more than `limit` notices changed.
+    """
+    if await db.run_sync(get_counter, NOTICE_CHANGES_FLOOR) > since:
+        return None
+    counts = defaultdict(int)
+    for table in (Notice, NoticeTombstone):
+        rows = await db.execute(
+            select(table.change_seq, func.count())
+            .where(table.change_seq > since, table.change_seq <= version)
+            .group_by(table.change_seq)
+        )
+        for change_seq, count in rows:
+            counts[change_seq] += count
+    changes = sorted(change_seq for change_seq in counts if not skip(change_seq))
+    if not changes:
+        return []
+    if sum(counts[change_seq] for change_seq in changes) > limit:
+        return None
+
+    notices = defaultdict(list)
+    created = set()
+    for row in await db.execute(
+        select(*NOTICE_COLUMNS, Notice.change_seq, Notice.created_seq).where(Notice.change_seq.in_(changes))
+    ):
+        notice = dict(row._mapping)
+        change_seq = notice.pop("change_seq")
+        if notice.pop("created_seq") == change_seq:
+            created.add(notice["id"])
+        notices[change_seq].append(notice)
+    tombstones = defaultdict(list)
+    for row in await db.execute(
+        select(NoticeTombstone.change_seq, NoticeTombstone.notice_id, NoticeTombstone.reason)
+        .where(NoticeTombstone.change_seq.in_(changes))
+    ):
+        tombstones[row.change_seq].append(row)
+
+    events = []
+    for change_seq in changes:
+        deleted = sorted(row.notice_id for row in tombstones[change_seq] if row.reason != "expired")
+        expired = sorted(row.notice_id for row in tombstones[change_seq] if row.reason == "expired")
+        upserted = notices[change_seq]
+        upserted_ids = sorted(notice["id"] for notice in upserted)
+        if expired:
+            events.append((change_seq, "expired", {"ids": expired}))
+        elif len(deleted) == 1:
+            events.append((change_seq, "deleted", {"id": deleted[0]}))
+        elif deleted:
+            events.append((change_seq, "bulk_deleted", {"ids": deleted}))
+        elif len(upserted) == 1:
+            events.append((change_seq, "created" if upserted_ids[0] in created else "updated", upserted[0]))
+        elif upserted:
+            event_type = "bulk_created" if created.issuperset(upserted_ids) else "bulk_updated"
+            events.append((change_seq, event_type, {"ids": upserted_ids}))
+    return events
+
+
+async def _relay_once(hub: BroadcastHub, cursor: int) -> int:
+    """
+    Publish the changes after `cursor` that this process has not published
+    itself and return the new cursor
+    """
+    async with AsyncSessionlocal() as db:
+        if await notice_cache.version(db) == cursor:
+            return cursor
+        # Read before the rows: anything up to this version has committed
+        version = await db.run_sync(get_counter, NOTICE_VERSION)
+        if version <= cursor:
+            return version
+        events = await _change_events(db, cursor, version, hub.queue_size, hub.published)
+    if events is None:
+        # More than a subscriber could queue, or truncated: they reload instead
+        hub.reset(version)
+        return version
+    for change_seq, event_type, data in events:
+        # Every earlier change has been sent, or was written again by a later one
+        hub.advance(change_seq - 1)
+        hub.publish(event_type, data, change_seq)
+    hub.advance(version)
+    return version
+
+
+async def subscribe_since(hub: BroadcastHub, last_event_id: Optional[str]) -> Optional[Subscriber]:
+    """
+    Subscribe to `hub`; a client reconnecting with Last-Event-ID first gets
+    the changes it missed from the change log. Returns None when the hub is
+    full.
+    """
+    if last_event_id is None or hub.full:
+        return hub.subscribe()
+    try:
+        since = int(last_event_id.strip())
+    except ValueError:
+        # Not an id this feed hands out
+        since = -1
+    missed = None
+    async with AsyncSessionlocal() as db:
+        version = await notice_cache.version(db)
+        if since == version:
+            missed = []
+        else:
+            # Read before the rows: anything up to this version has committed
+            version = await db.run_sync(get_counter, NOTICE_VERSION)
+            # An id above the version is from another database
+            if 0 <= since <= version:
+                missed = await _change_events(db, since, version, hub.queue_size)
+    return hub.subscribe(version, missed)
+
+
+async def relay_notice_changes(hub: BroadcastHub, interval: float = EVENT_RELAY_SECONDS):
+    """
+    Background task relaying other processes' notice changes to `hub`; runs
+    until cancelled
+    """
+    async with AsyncSessionlocal() as db:
+        cursor = await db.run_sync(get_counter, NOTICE_VERSION)
+    hub.advance(cursor)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            cursor = await _relay_once(hub, cursor)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error relaying notice changes: {e}")
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 """
 Script to clear all records from users and notice tables
+(for very large tables, `python bulk_data.py truncate` is faster)
 """
+from sqlalchemy import delete
 from db import Sessionlocal
-from models import Users, Notice
+from models import Users, Notice, NoticeArchive, NoticeTombstone
+from changes import reset_changes
+from principals import bump_users_version
 import logging
 
 # Set up logging
@@ -15,25 +19,24 @@ def clear_all_tables():
     db = Sessionlocal()
     try:
         # Clear notices table
-        notice_count = db.query(Notice).count()
-        db.query(Notice).delete()
+        notice_count = db.execute(delete(Notice)).rowcount
+        db.execute(delete(NoticeArchive))
+        db.execute(delete(NoticeTombstone))
         logger.info(f"Deleted {notice_count} notices")
         
         # Clear users table
-        user_count = db.query(Users).count()
-        db.query(Users).delete()
+        user_count = db.execute(delete(Users)).rowcount
         logger.info(f"Deleted {user_count} users")
         
+        # Let running API workers drop cached notices and principals, and
+        # delta sync clients reload the board
+        reset_changes(db)
+        bump_users_version(db)
+
         # Commit the changes
         db.commit()
         logger.info("All tables cleared successfully")
         
-        # Verify tables are empty
-        remaining_notices = db.query(Notice).count()
-        remaining_users = db.query(Users).count()
-        logger.info(f"Remaining notices: {remaining_notices}")
-        logger.info(f"Remaining users: {remaining_users}")
-        
     except Exception as e:
         logger.error(f"Error clearing tables: {e}")
         db.rollback()
@@ -0,0 +1,128 @@
+"""
+ASGI middleware for negotiated response compression.
+
+Responses are compressed with brotli when the client accepts it and the
+``brotli`` package is installed, otherwise with gzip, and only when the body
+is at least ``COMPRESSION_MINIMUM_SIZE`` bytes; small bodies cost more to
+compress than they save. Streaming responses are compressed chunk by chunk
+and flushed after every chunk, except Server-Sent Events, which pass through
+untouched so proxies and browsers see each event immediately.
+"""
+import os
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+GZIP_COMPRESSION_LEVEL = int(os.getenv("GZIP_COMPRESSION_LEVEL", "6"))
+# 4-5 is the usual sweet spot for compressing dynamic responses on the fly
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+
+UNCOMPRESSED_CONTENT_TYPES = ("text/event-stream", "image/", "video/", "audio/", "application/zip")
+
+
+def choose_encoding(accept_encoding: str) -> str:
+    """
+    Best encoding we support from an Accept-Encoding header, or "" for none
+    """
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding.strip()] = q
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_q = "", 0.0
+    for coding in candidates:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class _Compressor:
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._zlib = None
+        else:
+            self._brotli = None
+            # wbits=31: gzip container
+            self._zlib = zlib.compressobj(GZIP_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self._brotli is not None:
+            out = self._brotli.process(data)
+            return out + (self._brotli.finish() if final else self._brotli.flush())
+        out = self._zlib.compress(data)
+        return out + self._zlib.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        start_message = None
+        compressor = None
+        passthrough = False
+
+        async def send_wrapper(message: Message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                if (
+                    "content-encoding" in headers
+                    or message["status"] < 200 or message["status"] in (204, 304)
+                    or content_type.startswith(UNCOMPRESSED_CONTENT_TYPES)
+                ):
+                    passthrough = True
+                    await send(message)
+                    return
+                MutableHeaders(scope=message).add_vary_header("Accept-Encoding")
+                start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                # First body chunk: decide whether this response is worth compressing
+                response_start, start_message = start_message, None
+                if not encoding or (not more_body and len(body) < self.minimum_size):
+                    passthrough = True
+                    await send(response_start)
+                    await send(message)
+                    return
+                compressor = _Compressor(encoding)
+                headers = MutableHeaders(scope=response_start)
+                headers["Content-Encoding"] = encoding
+                del headers["Content-Length"]
+                body = compressor.compress(body, final=not more_body)
+                if not more_body:
+                    headers["Content-Length"] = str(len(body))
+                await send(response_start)
+            else:
+                body = compressor.compress(body, final=not more_body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,64 @@
+"""
+CORS with cached origin decisions.
+
+Starlette's CORSMiddleware answers preflights itself and checks the origin
+against ``allow_origin_regex`` on every cross-origin request. Our frontend
+sends the same handful of origins over and over, so each allow/deny decision
+is cached (bounded by ``CORS_ORIGIN_CACHE_SIZE``). ``CORS_MAX_AGE`` lets
+browsers reuse a preflight for that many seconds instead of repeating it
+before most calls (Chromium caps it at 7200, Firefox at 86400).
+
+Preflights are counted in ``cors_preflight_total`` and only a
+``CORS_PREFLIGHT_LOG_SAMPLE_RATE`` fraction of them is logged.
+"""
+import logging
+import os
+import random
+
+from starlette.datastructures import Headers
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CORS_MAX_AGE = int(os.getenv("CORS_MAX_AGE", "86400"))
+CORS_ORIGIN_CACHE_SIZE = int(os.getenv("CORS_ORIGIN_CACHE_SIZE", "1024"))
+CORS_PREFLIGHT_LOG_SAMPLE_RATE = float(os.getenv("CORS_PREFLIGHT_LOG_SAMPLE_RATE", "0.01"))
+
+cors_preflight_total = registry.counter("cors_preflight_total", "CORS preflight requests", ["result"])
+
+
+def log_sampled() -> bool:
+    """
+    Whether this request is one of the CORS_PREFLIGHT_LOG_SAMPLE_RATE logged
+    """
+    return CORS_PREFLIGHT_LOG_SAMPLE_RATE > 0 and random.random() < CORS_PREFLIGHT_LOG_SAMPLE_RATE
+
+
+class CachedCORSMiddleware(CORSMiddleware):
+    def __init__(self, *args, max_age: int = CORS_MAX_AGE, cache_size: int = CORS_ORIGIN_CACHE_SIZE, **kwargs):
+        super().__init__(*args, max_age=max_age, **kwargs)
+        self.cache_size = cache_size
+        self._origin_cache = {}
+
+    def is_allowed_origin(self, origin: str) -> bool:
+        allowed = self._origin_cache.get(origin)
+        if allowed is None:
+            allowed = super().is_allowed_origin(origin)
+            if len(self._origin_cache) >= self.cache_size:
+                self._origin_cache.clear()
+            self._origin_cache[origin] = allowed
+        return allowed
+
+    def preflight_response(self, request_headers: Headers) -> Response:
+        response = super().preflight_response(request_headers)
+        allowed = response.status_code == 200
+        cors_preflight_total.labels("allowed" if allowed else "denied").inc()
+        if log_sampled():
+            logger.info(
+                f"CORS preflight origin={request_headers['origin']} "
+                f"method={request_headers['access-control-request-method']} allowed={allowed}"
+            )
+        return response
@@ -0,0 +1,69 @@
+"""
+Named counters stored in the ``counters`` table.
+
+Counters are bumped inside the caller's transaction, so a counter change
+becomes visible to other workers exactly when the write it describes commits.
+"""
+from typing import Iterable
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from models import Counter
+
+
+def seed_counters(db: Session, names: Iterable[str]):
+    """
+    Make sure each counter row exists so bump_counter() is a single UPDATE
+    """
+    names = list(names)
+    existing = set(db.scalars(select(Counter.name).where(Counter.name.in_(names))))
+    for name in names:
+        if name not in existing:
+            db.add(Counter(name=name, value=0))
+    db.commit()
+
+
+def get_counter(db: Session, name: str) -> int:
+    value = db.scalar(select(Counter.value).where(Counter.name == name))
+    return value or 0
+
+
+def bump_counter(db: Session, name: str, amount: int = 1) -> int:
+    """
+    Increment a counter as part of the current transaction (not committed
+    here) and return its new value. The counter row stays locked until
+    commit, so concurrent bumps commit in the order of their values.
+    """
+    value = db.execute(
+        update(Counter)
+        .where(Counter.name == name)
+        .values(value=Counter.value + amount)
+        .returning(Counter.value)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if value is None:
+        db.add(Counter(name=name, value=amount))
+        return amount
+    return value
+
+
+def raise_counter(db: Session, name: str, value: int):
+    """
+    Set a counter to `value` unless it is already higher, as part of the
+    current transaction (not committed here)
+    """
+    result = db.execute(
+        update(Counter).where(Counter.name == name, Counter.value < value).values(value=value)
+    )
+    if not result.rowcount and db.get(Counter, name) is None:
+        db.add(Counter(name=name, value=value))
+
+
+def set_counter(db: Session, name: str, value: int):
+    """
+    Overwrite a counter as part of the current transaction (not committed here)
+    """
+    result = db.execute(update(Counter).where(Counter.name == name).values(value=value))
+    if not result.rowcount:
+        db.add(Counter(name=name, value=value))
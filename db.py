@@ -1,7 +1,14 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 import os
+import threading
+import time
+
+from metrics import current_route, db_statement_duration_seconds, db_statements_total, registry
 
 # Resolve database URL from environment, fallback to local SQLite
 raw_database_url = os.getenv("DATABASE_URL", "sqlite:///./notice.db")
@@ -10,11 +17,248 @@ raw_database_url = os.getenv("DATABASE_URL", "sqlite:///./notice.db")
 if raw_database_url.startswith("postgres://"):
     raw_database_url = raw_database_url.replace("postgres://", "postgresql+psycopg2://", 1)
 
-# Configure connect_args only for SQLite
-connect_args = {"check_same_thread": False} if raw_database_url.startswith("sqlite") else {}
+# Connection pool settings (per engine, per worker process)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# SQLite tuning, applied to every new connection
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Negative values are KiB: -65536 is a 64 MiB page cache per connection
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))
+
+
+class PoolStats:
+    """
+    Checkout counters and wait times for one engine's pool. Updated from
+    request threads and the event loop at once, so always under the lock.
+    """
+
+    # Checkouts slower than this count as having waited for a connection
+    SLOW_CHECKOUT_SECONDS = 0.01
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.slow_checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def increment(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if seconds >= self.SLOW_CHECKOUT_SECONDS:
+                self.slow_checkouts += 1
+
+    def snapshot(self, pool) -> dict:
+        with self._lock:
+            stats = {
+                "pool_class": type(pool).__name__,
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "slow_checkouts": self.slow_checkouts,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+            }
+        if isinstance(pool, QueuePool):
+            stats.update(
+                size=pool.size(),
+                checked_in=pool.checkedin(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow(),
+            )
+        return stats
+
+
+class _TimedCheckoutMixin:
+    """
+    Times how long each checkout waits for a pooled connection
+    """
+    stats: PoolStats
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.stats.increment("timeouts")
+            raise
+        finally:
+            self.stats.record_wait(time.perf_counter() - started)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.close()
+
+
+def _engine_kwargs(url, base_pool_class, stats: PoolStats) -> dict:
+    """
+    create_engine() arguments for `url`: a timed QueuePool sized from the
+    environment, except for in-memory SQLite which needs its default pool
+    """
+    kwargs = {"connect_args": {}}
+    if url.get_backend_name() == "sqlite":
+        kwargs["connect_args"]["check_same_thread"] = False
+        if url.database in (None, "", ":memory:"):
+            return kwargs
+    kwargs.update(
+        poolclass=type(f"Timed{base_pool_class.__name__}", (_TimedCheckoutMixin, base_pool_class), {"stats": stats}),
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+    return kwargs
+
+
+def _instrument(sync_engine, stats: PoolStats):
+    if sync_engine.dialect.name == "sqlite":
+        event.listen(sync_engine, "connect", _set_sqlite_pragmas)
+
+    @event.listens_for(sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        stats.increment("connects")
+
+    @event.listens_for(sync_engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats.increment("checkouts")
+
+    @event.listens_for(sync_engine, "invalidate")
+    def _on_invalidate(dbapi_connection, connection_record, exception):
+        stats.increment("invalidations")
+
+    # Per-route SQL timings; the route comes from MetricsMiddleware
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
 
-engine = create_engine(raw_database_url, connect_args=connect_args)
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        route = current_route.get()
+        db_statements_total.labels(route).inc()
+        db_statement_duration_seconds.labels(route).observe(elapsed)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(exception_context):
+        started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+        if started:
+            started.pop()
+
+
+def _async_database_url(url: str):
+    """
+    Same database as `url`, reached through an asyncio driver:
+    aiosqlite for SQLite and asyncpg for Postgres
+    """
+    url = make_url(url)
+    async_connect_args = {}
+    if url.get_backend_name() == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    elif url.get_backend_name() == "postgresql":
+        url = url.set(drivername="postgresql+asyncpg")
+        # asyncpg does not understand libpq's sslmode query parameter
+        sslmode = url.query.get("sslmode")
+        if sslmode:
+            url = url.difference_update_query(["sslmode"])
+            async_connect_args["ssl"] = sslmode
+    return url, async_connect_args
+
+
+def create_db_engine(url: str):
+    """
+    Blocking engine: scripts (make_admin.py, ...), startup DDL and background jobs
+    """
+    url = make_url(url)
+    stats = PoolStats()
+    db_engine = create_engine(url, **_engine_kwargs(url, QueuePool, stats))
+    _instrument(db_engine, stats)
+    db_engine.pool_stats = stats
+    return db_engine
+
+
+def create_async_db_engine(url: str):
+    """
+    Non-blocking engine used by the API routers
+    """
+    async_url, async_connect_args = _async_database_url(url)
+    stats = PoolStats()
+    kwargs = _engine_kwargs(async_url, AsyncAdaptedQueuePool, stats)
+    kwargs["connect_args"].update(async_connect_args)
+    if async_url.get_backend_name() == "sqlite":
+        # aiosqlite runs each connection on its own thread already
+        kwargs["connect_args"].pop("check_same_thread", None)
+    db_engine = create_async_engine(async_url, **kwargs)
+    _instrument(db_engine.sync_engine, stats)
+    db_engine.sync_engine.pool_stats = stats
+    return db_engine
+
+
+engine = create_db_engine(raw_database_url)
 
 Sessionlocal = sessionmaker(autoflush=False, autocommit=False, bind=engine)
 
+async_engine = create_async_db_engine(raw_database_url)
+
+AsyncSessionlocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+def dispose_engines_after_fork():
+    """
+    Drop pooled connections inherited from the parent process (gunicorn's
+    preloading master) without closing them, so a forked worker never shares
+    a socket or SQLite handle with its parent or siblings
+    """
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+
+
+def pool_status() -> dict:
+    """
+    Pool sizes, checkout counts and wait statistics for both engines
+    """
+    return {
+        "sync": engine.pool_stats.snapshot(engine.pool),
+        "async": async_engine.sync_engine.pool_stats.snapshot(async_engine.pool),
+    }
+
+
+_pool_gauges = {
+    name: registry.gauge(f"db_pool_{name}", f"Connection pool {name.replace('_', ' ')}", ["engine"])
+    for name in ("checked_out", "overflow", "checkouts", "timeouts", "slow_checkouts",
+                 "wait_seconds_total", "wait_seconds_max")
+}
+
+
+def _collect_pool_metrics():
+    for engine_name, stats in pool_status().items():
+        for name, gauge in _pool_gauges.items():
+            if name in stats:
+                gauge.labels(engine_name).set(stats[name])
+
+
+registry.on_collect(_collect_pool_metrics)
+
 BASE = declarative_base()
@@ -1,10 +1,7 @@
-from db import Sessionlocal
-from sqlalchemy.orm import Session
-from typing import Generator
+from db import AsyncSessionlocal
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import AsyncGenerator
 
-def get_db() -> Generator[Session, None, None]:
-    db = Sessionlocal()
-    try:
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionlocal() as db:
         yield db
-    finally:
-        db.close()
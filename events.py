@@ -0,0 +1,190 @@
+"""
+In-process broadcast hub for the live notice feed (GET /notice/stream).
+
+Every notice change is published once; the hub formats it as a Server-Sent
+Events message a single time and hands the same bytes to every subscriber's
+bounded queue, so an idle subscriber costs one queue and one waiting task.
+
+- A subscriber whose queue fills up (a slow client) is dropped after its
+  queued messages are sent; it reconnects with Last-Event-ID and catches up.
+- Event ids are notice change sequences (see changes.py), the same in every
+  worker: a client that has seen id N has seen every change up to N. A
+  reconnect, to any worker, replays the changes after N from the change log
+  (``changes.subscribe_since``), or sends a ``reset`` event when the client
+  missed too much and should reload the board.
+
+Changes made by other processes reach this hub through
+``changes.relay_notice_changes``; publishing with the change's ``change_seq``
+makes sure each change is sent once, whichever path sees it first. Local
+changes are sent right away and can overtake another worker's earlier change
+still on its way through the relay, so an event's id is the highest sequence
+up to which every change has been sent, which may be below its own.
+"""
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict, deque
+from typing import List, Optional, Set, Tuple
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+EVENT_REPLAY_SIZE = int(os.getenv("EVENT_REPLAY_SIZE", "256"))
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "64"))
+EVENT_HEARTBEAT_SECONDS = float(os.getenv("EVENT_HEARTBEAT_SECONDS", "15"))
+EVENT_MAX_SUBSCRIBERS = int(os.getenv("EVENT_MAX_SUBSCRIBERS", "10000"))
+# Change sequences remembered to avoid publishing a change twice
+PUBLISHED_SEQS_SIZE = 4096
+
+HEARTBEAT = b": ping\n\n"
+
+
+def format_event(event_id: int, event_type: str, data) -> bytes:
+    payload = json.dumps(data, separators=(",", ":"), default=str)
+    return f"id: {event_id}\nevent: {event_type}\ndata: {payload}\n\n".encode()
+
+
+class Subscriber:
+    def __init__(self, queue_size: int):
+        self.queue: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+
+class BroadcastHub:
+    def __init__(self, replay_size: int = EVENT_REPLAY_SIZE, queue_size: int = EVENT_QUEUE_SIZE,
+                 max_subscribers: int = EVENT_MAX_SUBSCRIBERS):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._subscribers: Set[Subscriber] = set()
+        # Recent messages by change_seq, for subscribers resuming from the change log
+        self._replay: "deque[tuple[int, bytes]]" = deque(maxlen=replay_size)
+        self._evicted_seq = 0
+        # change_seq of recently published changes, oldest first
+        self._published: "OrderedDict[int, None]" = OrderedDict()
+        # Every change up to here has been sent; None until the relay runs,
+        # when this process makes every change and ids are their own sequence
+        self._delivered: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def full(self) -> bool:
+        return len(self._subscribers) >= self.max_subscribers
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        Bind to the server's event loop so other threads can publish
+        """
+        self._loop = loop
+
+    def published(self, change_seq: int) -> bool:
+        return change_seq in self._published
+
+    def advance(self, change_seq: int):
+        """
+        Record that every change up to `change_seq` has been sent. Called by
+        the relay, which reads the change log in order.
+        """
+        if self._delivered is None or change_seq > self._delivered:
+            self._delivered = change_seq
+
+    def publish(self, event_type: str, data, change_seq: int):
+        """
+        Fan an event out to all subscribers, unless the change `change_seq`
+        has been published already. Must run on the event loop.
+        """
+        if change_seq in self._published:
+            return
+        self._published[change_seq] = None
+        if len(self._published) > PUBLISHED_SEQS_SIZE:
+            self._published.popitem(last=False)
+        if self._delivered is not None and change_seq == self._delivered + 1:
+            self._delivered = change_seq
+        self._broadcast(change_seq, event_type, data)
+
+    def reset(self, change_seq: int):
+        """
+        Tell every subscriber to reload the board, as of change `change_seq`
+        """
+        self.advance(change_seq)
+        self._broadcast(change_seq, "reset", {})
+
+    def _broadcast(self, change_seq: int, event_type: str, data):
+        event_id = change_seq if self._delivered is None else self._delivered
+        message = format_event(event_id, event_type, data)
+        if len(self._replay) == self._replay.maxlen:
+            self._evicted_seq = max(self._evicted_seq, self._replay[0][0])
+        self._replay.append((change_seq, message))
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too slow to keep up: let it drain and reconnect with Last-Event-ID
+                subscriber.overflowed = True
+                self._subscribers.discard(subscriber)
+
+    def publish_threadsafe(self, event_type: str, data, change_seq: int):
+        """
+        publish() from a background thread (e.g. the expiry scheduler)
+        """
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self.publish, event_type, data, change_seq)
+
+    def subscribe(self, version: Optional[int] = None,
+                  missed: Optional[List[Tuple[int, str, dict]]] = None) -> Optional[Subscriber]:
+        """
+        Register a subscriber. A resuming one passes the change log's
+        `version` and the (change_seq, event_type, data) it `missed` up to
+        there, None when it has to reload; it is pre-filled with those and
+        with whatever this hub sent after `version`. Returns None when the
+        hub is full.
+        """
+        if self.full:
+            return None
+        subscriber = Subscriber(self.queue_size)
+        if version is not None:
+            self._replay_since(subscriber, version, missed)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self._subscribers.discard(subscriber)
+
+    def _replay_since(self, subscriber: Subscriber, version: int, missed: Optional[List[Tuple[int, str, dict]]]):
+        recent = [message for change_seq, message in self._replay if change_seq > version]
+        # Replay at most a queue's worth; anything more means a full reload anyway
+        if missed is None or self._evicted_seq > version or len(missed) + len(recent) > self.queue_size:
+            subscriber.queue.put_nowait(format_event(version, "reset", {}))
+            return
+        for change_seq, event_type, data in missed:
+            subscriber.queue.put_nowait(format_event(change_seq, event_type, data))
+        for message in recent:
+            subscriber.queue.put_nowait(message)
+
+    async def stream(self, subscriber: Subscriber, heartbeat: float = EVENT_HEARTBEAT_SECONDS):
+        """
+        Body iterator for a StreamingResponse
+        """
+        try:
+            # Tell EventSource how long to wait before reconnecting
+            yield b"retry: 3000\n\n"
+            while True:
+                if subscriber.overflowed and subscriber.queue.empty():
+                    return
+                try:
+                    yield await asyncio.wait_for(subscriber.queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT
+        finally:
+            self.unsubscribe(subscriber)
+
+
+notice_hub = BroadcastHub()
+
+_subscribers_gauge = registry.gauge("notice_stream_subscribers", "Open GET /notice/stream connections")
+registry.on_collect(lambda: _subscribers_gauge.set(notice_hub.subscriber_count))
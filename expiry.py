@@ -0,0 +1,208 @@
+"""
+Notice expiry engine.
+
+Expired notices (event_date in the past) are hidden from reads by
+``active_notice_filter`` and moved to the ``notice_archive`` table in the
+background by a single scheduler thread, which also drops archived notices
+older than ``NOTICE_ARCHIVE_RETENTION_DAYS``. Only the process holding the
+``notice-expiry`` leader lock does this, so running several gunicorn workers
+does not multiply the work. POST /notice/cleanup-expired archives right away
+in whichever worker receives it.
+
+Both steps work in batches of ``NOTICE_ARCHIVE_BATCH_SIZE`` rows, one short
+transaction each (INSERT ... SELECT plus DELETE by primary key), so writers
+are never blocked for long however much has expired. A batch picks its rows
+only after locking the notice version, so concurrent runs never archive the
+same notice twice.
+"""
+import logging
+import os
+import threading
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import DateTime, delete, insert, literal, or_, select
+from sqlalchemy.orm import Session
+
+from cache import notice_cache
+from changes import add_tombstones, purge_tombstones, record_notice_change
+from db import Sessionlocal
+from events import notice_hub
+from leader import LeaderLock
+from metrics import background_job_duration_seconds, background_job_failures_total, current_route
+from models import Notice, NoticeArchive
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_INTERVAL_SECONDS = int(os.getenv("EXPIRY_INTERVAL_SECONDS", "3600"))
+NOTICE_ARCHIVE_BATCH_SIZE = int(os.getenv("NOTICE_ARCHIVE_BATCH_SIZE", "500"))
+# Days archived notices are kept; 0 keeps them forever
+NOTICE_ARCHIVE_RETENTION_DAYS = int(os.getenv("NOTICE_ARCHIVE_RETENTION_DAYS", "365"))
+
+# Notice columns copied into the archive, by name
+ARCHIVED_FIELDS = (
+    "title", "description", "post_date", "event_date", "event_start_time", "event_end_time", "type",
+)
+
+
+def active_notice_filter(today: Optional[date] = None):
+    """
+    Query predicate for notices that have not expired yet
+    """
+    today = today or date.today()
+    return or_(Notice.event_date.is_(None), Notice.event_date >= today)
+
+
+def _archive_batch(db: Session, today: date, batch_size: int) -> Tuple[List[int], Optional[int]]:
+    # Index order (ix_notice_event_date), so each batch is a range scan
+    expired = select(Notice.id).where(Notice.event_date < today).order_by(Notice.event_date, Notice.id).limit(batch_size)
+    # Cheap check first: no version bump when nothing has expired
+    if db.scalar(expired.limit(1)) is None:
+        return [], None
+    # Bumping the version locks its counter row until commit; read the batch
+    # after that, so a concurrent run's archived rows are already gone
+    change = record_notice_change(db)
+    expired_ids = db.scalars(expired).all()
+    if not expired_ids:
+        return [], None
+    archived_at = literal(change["updated_at"], DateTime(timezone=True))
+    db.execute(insert(NoticeArchive).from_select(
+        ["notice_id", *ARCHIVED_FIELDS, "archived_at"],
+        select(Notice.id, *(getattr(Notice, field) for field in ARCHIVED_FIELDS), archived_at)
+        .where(Notice.id.in_(expired_ids)),
+    ))
+    db.execute(
+        delete(Notice).where(Notice.id.in_(expired_ids)).execution_options(synchronize_session=False)
+    )
+    add_tombstones(db, expired_ids, change, "expired")
+    return expired_ids, change["change_seq"]
+
+
+def archive_expired_notices(batch_size: int = NOTICE_ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Move notices that have expired (event_date is in the past) to
+    notice_archive, committing after every batch
+    """
+    current_route.set("job:notice_expiry")
+    today = date.today()
+    total = 0
+    with background_job_duration_seconds.time("notice_expiry"):
+        while True:
+            db = Sessionlocal()
+            try:
+                expired_ids, change_seq = _archive_batch(db, today, batch_size)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                background_job_failures_total.labels("notice_expiry").inc()
+                logger.error(f"Error archiving expired notices: {e}")
+                break
+            finally:
+                db.close()
+            if not expired_ids:
+                break
+            total += len(expired_ids)
+            notice_cache.invalidate()
+            notice_hub.publish_threadsafe("expired", {"ids": expired_ids}, change_seq)
+            if len(expired_ids) < batch_size:
+                break
+    if total:
+        logger.info(f"Archived {total} expired notices")
+    return total
+
+
+def purge_archive(retention_days: int = NOTICE_ARCHIVE_RETENTION_DAYS, batch_size: int = NOTICE_ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Delete archived notices older than the retention period, in batches
+    """
+    if retention_days <= 0:
+        return 0
+    current_route.set("job:notice_archive_retention")
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    total = 0
+    with background_job_duration_seconds.time("notice_archive_retention"):
+        while True:
+            db = Sessionlocal()
+            try:
+                ids = db.scalars(
+                    select(NoticeArchive.id)
+                    .where(NoticeArchive.archived_at < cutoff)
+                    .order_by(NoticeArchive.archived_at, NoticeArchive.id)
+                    .limit(batch_size)
+                ).all()
+                if ids:
+                    db.execute(delete(NoticeArchive).where(NoticeArchive.id.in_(ids)))
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                background_job_failures_total.labels("notice_archive_retention").inc()
+                logger.error(f"Error purging the notice archive: {e}")
+                break
+            finally:
+                db.close()
+            total += len(ids)
+            if len(ids) < batch_size:
+                break
+    if total:
+        logger.info(f"Purged {total} archived notices older than {retention_days} days")
+    return total
+
+
+class ExpiryScheduler:
+    """
+    Background thread that archives expired notices and applies the archive
+    and tombstone retention every ``interval`` seconds while this process is
+    the expiry leader
+    """
+
+    def __init__(self, interval: int = EXPIRY_INTERVAL_SECONDS):
+        self.interval = interval
+        self.leader_lock = LeaderLock("notice-expiry")
+        # Serialises jobs (and the leader lock) between the scheduler thread
+        # and jobs triggered by hand in this process
+        self._job_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="notice-expiry", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        self.leader_lock.release()
+
+    def run_as_leader(self, *jobs: Callable[[], int]) -> bool:
+        """
+        Run `jobs` now if this process is the expiry leader, never alongside
+        the scheduled run. Returns False when another process is the leader.
+        """
+        with self._job_lock:
+            if not self.leader_lock.try_acquire():
+                return False
+            for job in jobs:
+                job()
+            return True
+
+    def trigger(self):
+        """
+        Archive expired notices now, for POST /notice/cleanup-expired. Runs in
+        any process: batches are safe to run concurrently with the leader's.
+        """
+        with self._job_lock:
+            archive_expired_notices()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_as_leader(archive_expired_notices, purge_archive, purge_tombstones)
+            except Exception as e:
+                logger.error(f"Error in periodic cleanup: {e}")
+            self._stop.wait(self.interval)
+
+
+scheduler = ExpiryScheduler()
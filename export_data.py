@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Script to export notices or users as NDJSON or CSV, streaming in batches
+Usage: python export_data.py notices|users [--format ndjson|csv] [--output FILE] [--with-password-hashes]
+"""
+import argparse
+import sys
+
+from db import Sessionlocal
+from export import ExportFormat, iter_export, notice_export_query, user_export_query
+
+
+def export_table(table: str, fmt: ExportFormat, out, with_password_hashes: bool = False):
+    """Write every row of `table` to the binary file `out`"""
+    if table == "notices":
+        query = notice_export_query()
+    else:
+        query = user_export_query(with_password_hashes)
+    with Sessionlocal() as db:
+        for chunk in iter_export(db, query, fmt):
+            out.write(chunk)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export notices or users")
+    parser.add_argument("table", choices=["notices", "users"])
+    parser.add_argument("--format", choices=[f.value for f in ExportFormat], default=ExportFormat.ndjson.value)
+    parser.add_argument("--output", help="file to write (default: stdout)")
+    parser.add_argument("--with-password-hashes", action="store_true",
+                        help="include users' bcrypt hashes, for a restorable backup")
+    args = parser.parse_args()
+
+    if args.output:
+        with open(args.output, "wb") as f:
+            export_table(args.table, ExportFormat(args.format), f, args.with_password_hashes)
+        print(f"✅ Exported {args.table} to {args.output}", file=sys.stderr)
+    else:
+        export_table(args.table, ExportFormat(args.format), sys.stdout.buffer, args.with_password_hashes)
@@ -1,12 +1,53 @@
 # Gunicorn configuration file for Railway deployment
+import math
 import os
+import sys
 
 # Server socket
 bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
 backlog = 2048
 
-# Worker processes
-workers = 1  # Railway works best with 1 worker
+
+def available_cpus() -> int:
+    """
+    CPUs this container may use: the scheduler affinity, further limited by
+    a cgroup CPU quota (os.cpu_count() reports the host's cores)
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1: a quota of -1 means no limit
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+# Worker processes: one per available CPU, at most WEB_CONCURRENCY_MAX, unless
+# WEB_CONCURRENCY says otherwise. Each worker opens up to two database pools
+# of DB_POOL_SIZE + DB_MAX_OVERFLOW connections, so keep
+# workers * 2 * (DB_POOL_SIZE + DB_MAX_OVERFLOW) below the server's
+# max_connections. Background jobs run in whichever worker holds their leader
+# lock, and the live feed relays changes between workers (EVENT_RELAY_SECONDS).
+WEB_CONCURRENCY_MAX = int(os.getenv("WEB_CONCURRENCY_MAX", "4"))
+workers = int(os.getenv("WEB_CONCURRENCY") or min(available_cpus(), WEB_CONCURRENCY_MAX))
 worker_class = "uvicorn.workers.UvicornWorker"
 worker_connections = 1000
 timeout = 30
@@ -16,6 +57,16 @@ keepalive = 2
 max_requests = 1000
 max_requests_jitter = 50
 
+# Import the app once in the master and fork workers from it: startup is
+# faster and code pages are shared copy-on-write between workers
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ("1", "true", "yes")
+
+# Proxies trusted to rewrite the client address from X-Forwarded-For. Only
+# list fixed proxy addresses here: with "*" uvicorn takes the leftmost entry,
+# which the client controls. Platform proxies without fixed addresses are
+# handled by RATE_LIMIT_PROXY_HOPS in ratelimit.py instead.
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
 # Logging
 accesslog = "-"
 errorlog = "-"
@@ -33,4 +84,27 @@ tmp_upload_dir = None
 
 # SSL (not needed on Railway as they handle SSL)
 keyfile = None
-certfile = None 
\ No newline at end of file
+certfile = None
+
+
+def when_ready(server):
+    """
+    Migrate the schema once in the master, before any worker starts, so
+    workers only see an up-to-date schema
+    """
+    if not preload_app:
+        return
+    from db import engine
+    from migrations import ensure_schema
+    ensure_schema()
+    # The master serves no requests; don't leave connections for workers to inherit
+    engine.dispose()
+
+
+def post_fork(server, worker):
+    """
+    Workers must not reuse connections pooled by the master
+    """
+    if "db" in sys.modules:
+        from db import dispose_engines_after_fork
+        dispose_engines_after_fork()
@@ -0,0 +1,66 @@
+"""
+ASGI middleware that records per-route request metrics.
+
+Requests are labelled with their route template (``/notice/{notice_id}``),
+never the raw path, so label cardinality stays bounded. The template is also
+published through ``metrics.current_route`` so SQL statement timings recorded
+by the engine event hooks in db.py are attributed to the route that issued
+them.
+"""
+import time
+
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from metrics import current_route, http_request_duration_seconds, http_requests_in_flight
+
+UNMATCHED_ROUTE = "unmatched"
+ROUTE_CACHE_SIZE = 4096
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._route_cache = {}
+
+    def _route_template(self, scope: Scope) -> str:
+        key = (scope["method"], scope["path"])
+        template = self._route_cache.get(key)
+        if template is None:
+            template = UNMATCHED_ROUTE
+            for route in scope["app"].router.routes:
+                match, _ = route.matches(scope)
+                if match != Match.NONE:
+                    template = getattr(route, "path", UNMATCHED_ROUTE)
+                    if match == Match.FULL:
+                        break
+            if len(self._route_cache) >= ROUTE_CACHE_SIZE:
+                self._route_cache.clear()
+            self._route_cache[key] = template
+        return template
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = self._route_template(scope)
+        token = current_route.set(route)
+        in_flight = http_requests_in_flight.labels(method, route)
+        in_flight.inc()
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_request_duration_seconds.labels(method, route, status_code).observe(time.perf_counter() - started)
+            in_flight.dec()
+            current_route.reset(token)
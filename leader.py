@@ -0,0 +1,125 @@
+"""
+Cross-process leader election for background jobs.
+
+Every gunicorn worker runs the app lifespan, so jobs such as the notice expiry
+sweep would otherwise run once per worker. A ``LeaderLock`` lets exactly one
+process own a job:
+
+- SQLite (and other file based setups) take an exclusive, non-blocking
+  ``flock`` on a lock file next to the database.
+- Postgres takes a session-level advisory lock on a dedicated connection.
+
+The lock is held until ``release()`` or until the owning process dies, at which
+point another worker picks it up on its next ``try_acquire()``.
+"""
+import logging
+import os
+import tempfile
+import zlib
+
+from sqlalchemy import text
+
+from db import engine
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, assume a single local process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LEADER_LOCK_DIR = os.getenv("LEADER_LOCK_DIR", "").strip()
+
+
+def _lock_file_path(name: str) -> str:
+    if LEADER_LOCK_DIR:
+        return os.path.join(LEADER_LOCK_DIR, f"{name}.lock")
+    database = engine.url.database if engine.dialect.name == "sqlite" else None
+    if database and database != ":memory:":
+        return f"{os.path.abspath(database)}.{name}.lock"
+    return os.path.join(tempfile.gettempdir(), f"noticeboard.{name}.lock")
+
+
+class LeaderLock:
+    def __init__(self, name: str):
+        self.name = name
+        self._file = None
+        self._conn = None
+        self._is_leader = False
+
+    @property
+    def is_leader(self) -> bool:
+        return self._is_leader
+
+    def try_acquire(self) -> bool:
+        """
+        Become leader if nobody else is. Cheap to call repeatedly: once held,
+        only the health of the underlying lock is checked.
+        """
+        try:
+            if engine.dialect.name == "postgresql":
+                self._is_leader = self._acquire_advisory()
+            else:
+                self._is_leader = self._acquire_file()
+        except Exception as e:
+            logger.error(f"Leader election for '{self.name}' failed: {e}")
+            self.release()
+        if self._is_leader:
+            logger.debug(f"Process {os.getpid()} is leader for '{self.name}'")
+        return self._is_leader
+
+    def release(self):
+        if self._conn is not None:
+            try:
+                self._conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self._key})
+                self._conn.commit()
+            except Exception:
+                pass
+            finally:
+                self._conn.close()
+                self._conn = None
+        if self._file is not None:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(self._file, fcntl.LOCK_UN)
+            finally:
+                self._file.close()
+                self._file = None
+        self._is_leader = False
+
+    @property
+    def _key(self) -> int:
+        return zlib.crc32(f"noticeboard:{self.name}".encode())
+
+    def _acquire_advisory(self) -> bool:
+        if self._conn is not None:
+            # Still leader as long as the session holding the lock is alive
+            self._conn.execute(text("SELECT 1"))
+            self._conn.commit()
+            return True
+        conn = engine.connect()
+        acquired = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self._key}).scalar()
+        conn.commit()
+        if not acquired:
+            conn.close()
+            return False
+        self._conn = conn
+        return True
+
+    def _acquire_file(self) -> bool:
+        if self._file is not None:
+            return True
+        if fcntl is None:
+            return True
+        lock_file = open(_lock_file_path(self.name), "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self._file = lock_file
+        return True
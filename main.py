@@ -1,55 +1,53 @@
-from fastapi import FastAPI, Request
-from fastapi.middleware.cors import CORSMiddleware
-from auth import router as auth_router
-from notice import router as notice_router, delete_expired_notices
-import asyncio
-import threading
-import time
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from auth import get_current_user, router as auth_router
+from notice import router as notice_router
+from expiry import scheduler as expiry_scheduler
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import os
-from db import BASE, engine
+from db import async_engine, pool_status
+from migrations import HEAD as SCHEMA_VERSION, ensure_schema
+from passwords import password_hasher
+from events import notice_hub
+from changes import EVENT_RELAY_SECONDS, relay_notice_changes
+from instrumentation import MetricsMiddleware
+from compression import CompressionMiddleware
+from ratelimit import RateLimitMiddleware
+from cors import CachedCORSMiddleware, log_sampled
+from profiling import ProfilingMiddleware, router as profiling_router
+from metrics import registry as metrics_registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from principals import Principal
+from typing import Annotated
+import asyncio
 from contextlib import asynccontextmanager
 import logging
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Global variable to control the cleanup thread
-cleanup_thread = None
-stop_cleanup = False
-
-def periodic_cleanup():
+def prepare_database():
     """
-    Background thread that runs cleanup every 24 hours
+    Check the schema version, migrating first if the database is behind
     """
-    global stop_cleanup
-    while not stop_cleanup:
-        try:
-            # Run cleanup
-            delete_expired_notices()
-            # Sleep for 24 hours (86400 seconds)
-            time.sleep(86400)
-        except Exception as e:
-            print(f"Error in periodic cleanup: {e}")
-            # If there's an error, wait 1 hour before trying again
-            time.sleep(3600)
+    ensure_schema()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global cleanup_thread, stop_cleanup
-    stop_cleanup = False
     # Startup logic
-    cleanup_thread = threading.Thread(target=periodic_cleanup, daemon=True)
-    cleanup_thread.start()
-    print("Automatic notice cleanup started - will run every 24 hours")
-    BASE.metadata.create_all(bind=engine)
-    print("Database tables checked/created")
+    prepare_database()
+    print(f"Database schema at version {SCHEMA_VERSION}")
+    notice_hub.start(asyncio.get_running_loop())
+    # Changes made by other workers reach this worker's live feed through the change log
+    relay = asyncio.create_task(relay_notice_changes(notice_hub)) if EVENT_RELAY_SECONDS > 0 else None
+    expiry_scheduler.start()
+    print(f"Automatic notice cleanup started - leader runs it every {expiry_scheduler.interval} seconds")
     yield
     # Shutdown logic
-    stop_cleanup = True
-    if cleanup_thread:
-        cleanup_thread.join(timeout=5)
+    if relay is not None:
+        relay.cancel()
+    expiry_scheduler.stop()
+    password_hasher.shutdown()
+    await async_engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -77,8 +75,13 @@ else:
 # Allow regex for dynamic preview deployments (e.g., Vercel)
 allow_origin_regex = frontend_origin_regex_env or r"https://.*\.vercel\.app$"
 
+# Load shedding and per-IP rate limits; added first so it runs inside CORS
+# and its 429/503 responses still carry CORS headers
+app.add_middleware(RateLimitMiddleware)
+
+# Answers preflights itself, with cached origin decisions and a long max_age (CORS_MAX_AGE)
 app.add_middleware(
-    CORSMiddleware,
+    CachedCORSMiddleware,
     allow_origins=allow_origins,
     allow_origin_regex=allow_origin_regex,
     allow_credentials=True,
@@ -87,6 +90,15 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# gzip/brotli for bodies above COMPRESSION_MINIMUM_SIZE
+app.add_middleware(CompressionMiddleware)
+
+# cProfile for sampled requests and admin requests with X-Profile: 1 (opt-in)
+app.add_middleware(ProfilingMiddleware)
+
+# Outermost, so latency includes every other middleware
+app.add_middleware(MetricsMiddleware)
+
 @app.get("/")
 async def root():
     """
@@ -105,19 +117,39 @@ async def health_check():
     """
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat(),
+        "password_hasher": password_hasher.stats()
     }
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Prometheus text exposition of this worker's metrics
+    """
+    return Response(content=metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/health/db")
+async def database_pool_health(current_user: Annotated[Principal, Depends(get_current_user)]):
+    """
+    Connection pool sizes, checkout counts and wait times, for pool sizing - Admin only
+    """
+    if not current_user.admin:
+        raise HTTPException(status_code=403, detail="Only admins can read connection pool statistics")
+    return pool_status()
+
 @app.options("/{full_path:path}")
 async def options_handler(full_path: str, request: Request):
     """
-    Handle OPTIONS requests for CORS preflight
+    Handle OPTIONS requests that are not CORS preflights (those are answered
+    by the CORS middleware)
     """
-    origin = request.headers.get("origin", "<no-origin>")
-    req_method = request.headers.get("access-control-request-method", "<no-acr-method>")
-    logging.info(f"OPTIONS preflight for path=/{full_path} origin={origin} method={req_method}")
+    if log_sampled():
+        origin = request.headers.get("origin", "<no-origin>")
+        req_method = request.headers.get("access-control-request-method", "<no-acr-method>")
+        logging.info(f"OPTIONS request for path=/{full_path} origin={origin} method={req_method}")
     return {"message": "OK"}
 
 # Register routers
 app.include_router(auth_router)
 app.include_router(notice_router)
+app.include_router(profiling_router)
@@ -8,6 +8,7 @@ import sys
 from sqlalchemy.orm import Session
 from db import Sessionlocal
 from models import Users
+from principals import bump_users_version
 
 def make_user_admin(email: str):
     """Make a user admin by their email"""
@@ -22,6 +23,8 @@ def make_user_admin(email: str):
         
         # Update admin status
         user.admin = True
+        # Running API workers drop their cached principal for this user
+        bump_users_version(db)
         db.commit()
         
         print(f"✅ Successfully made user '{email}' an admin!")
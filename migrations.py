@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations.
+
+Applied revisions are recorded in the ``schema_migrations`` table. App startup
+only reads the current version (one query); when the database is behind, one
+process applies the missing revisions while holding the ``schema-migrations``
+leader lock and every other process waits for it to finish.
+
+Revisions must be idempotent (``IF NOT EXISTS``, check before altering): a
+new database runs every revision from the baseline on, and a revision
+interrupted half-way is simply applied again. Each revision spells out the
+tables, columns and indexes it creates as they were when it was written,
+never through models.py, so it does the same thing however the models change
+later; a model change gets a new revision.
+
+Usage:
+    python migrations.py            # apply pending revisions
+    python migrations.py status
+"""
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, List
+
+from sqlalchemy import (
+    BigInteger, Boolean, Column, Date, DateTime, Index, Integer, MetaData, String, Table, Time, bindparam, exc, func,
+    insert, inspect, select, text, update,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
+
+from db import Sessionlocal, engine
+from leader import LeaderLock
+
+logger = logging.getLogger(__name__)
+
+# Apply pending revisions at startup; when false, startup refuses to run on an old schema
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+MIGRATION_LOCK_TIMEOUT = float(os.getenv("MIGRATION_LOCK_TIMEOUT", "300"))
+
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), nullable=False),
+)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    upgrade: Callable[[Engine], None]
+
+
+def _create_indexes(bind: Engine, indexes: List[Index]):
+    """
+    Create the indexes an existing database is still missing. Raises
+    RuntimeError when a unique index cannot be built over duplicate rows, so
+    the revision asking for it is not recorded and runs again once they are
+    removed.
+    """
+    failed = []
+    for index in indexes:
+        # IF NOT EXISTS rather than checkfirst: reflection cannot see expression indexes
+        try:
+            with bind.begin() as conn:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+        except exc.IntegrityError as e:
+            # A unique index over existing duplicates; try the others before failing
+            logger.error(f"Could not create unique index {index.name}: {e.orig}")
+            failed.append(f"{index.name} on {index.table.name}({', '.join(column.name for column in index.columns)})")
+    if failed:
+        raise RuntimeError(
+            f"Could not create unique index {'; '.join(failed)}: the table has duplicate values. "
+            "Remove the duplicate rows and start the app (or run `python migrations.py`) again"
+        )
+
+
+# Revisions 1 and 2: the tables and indexes of the first versioned schema
+_baseline_schema = MetaData()
+_baseline_users = Table(
+    "users",
+    _baseline_schema,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("email", String, unique=True, index=True),
+    Column("first_name", String),
+    Column("last_name", String),
+    Column("mobile_no", String, unique=True, index=True),
+    Column("hashed_password", String),
+    Column("admin", Boolean, default=False),
+)
+# Case-insensitive prefix search on GET /auth/users; Postgres moves them to COLLATE "C" in revision 7
+Index("ix_users_lower_email", func.lower(_baseline_users.c.email))
+Index("ix_users_lower_first_name", func.lower(_baseline_users.c.first_name))
+Index("ix_users_lower_last_name", func.lower(_baseline_users.c.last_name))
+Table(
+    "notice",
+    _baseline_schema,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("title", String),
+    Column("description", String),
+    Column("post_date", Date),
+    Column("event_date", Date, nullable=True, index=True),
+    Column("event_start_time", Time, nullable=True),
+    Column("event_end_time", Time, nullable=True),
+    Column("type", String),
+    Index("ix_notice_post_date_id", "post_date", "id"),
+    Index("ix_notice_type_post_date_id", "type", "post_date", "id"),
+)
+Table(
+    "counters",
+    _baseline_schema,
+    Column("name", String, primary_key=True),
+    Column("value", BigInteger, nullable=False, default=0),
+)
+
+
+def _baseline(bind: Engine):
+    _baseline_schema.create_all(bind=bind)
+
+
+def _baseline_indexes(bind: Engine):
+    # Databases created before migrations had the tables but not all indexes
+    _create_indexes(bind, [index for table in _baseline_schema.sorted_tables for index in table.indexes])
+
+
+def _search_index(bind: Engine):
+    from search import create_search_index
+    create_search_index(bind)
+
+
+def _counters(bind: Engine):
+    from cache import NOTICE_LAST_MODIFIED, NOTICE_VERSION
+    from counters import seed_counters
+    from principals import USERS_VERSION
+    with Sessionlocal(bind=bind) as db:
+        seed_counters(db, [NOTICE_VERSION, NOTICE_LAST_MODIFIED, USERS_VERSION])
+        # users_count, dropped again by revision 10
+        db.execute(text(
+            "INSERT INTO counters (name, value) SELECT 'users_count', count(*) FROM users "
+            "WHERE NOT EXISTS (SELECT 1 FROM counters WHERE name = 'users_count')"
+        ))
+        db.commit()
+
+
+def _notice_archive(bind: Engine):
+    Table(
+        "notice_archive",
+        MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("notice_id", Integer, nullable=False, index=True),
+        Column("title", String),
+        Column("description", String),
+        Column("post_date", Date),
+        Column("event_date", Date, nullable=True),
+        Column("event_start_time", Time, nullable=True),
+        Column("event_end_time", Time, nullable=True),
+        Column("type", String),
+        Column("archived_at", DateTime(timezone=True), nullable=False, index=True),
+    ).create(bind=bind, checkfirst=True)
+
+
+def _notice_change_tracking(bind: Engine):
+    from cache import NOTICE_VERSION
+    from changes import NOTICE_CHANGES_FLOOR
+    from counters import get_counter, seed_counters
+    notice = Table(
+        "notice",
+        MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("updated_at", DateTime(timezone=True), nullable=True),
+        Column("change_seq", BigInteger, nullable=True, index=True),
+    )
+    existing = {column["name"] for column in inspect(bind).get_columns("notice")}
+    with bind.begin() as conn:
+        for column in (notice.c.updated_at, notice.c.change_seq):
+            if column.name not in existing:
+                conn.execute(text(f"ALTER TABLE notice ADD COLUMN {column.name} {column.type.compile(bind.dialect)}"))
+    Table(
+        "notice_tombstones",
+        MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("notice_id", Integer, nullable=False),
+        Column("change_seq", BigInteger, nullable=False, index=True),
+        Column("deleted_at", DateTime(timezone=True), nullable=False, index=True),
+        Column("reason", String, nullable=False),
+    ).create(bind=bind, checkfirst=True)
+    _create_indexes(bind, list(notice.indexes))
+    with Sessionlocal(bind=bind) as db:
+        seed_counters(db, [NOTICE_CHANGES_FLOOR])
+        # Existing notices count as changed at the current version
+        db.execute(
+            update(notice)
+            .where(notice.c.change_seq.is_(None))
+            .values(change_seq=get_counter(db, NOTICE_VERSION), updated_at=datetime.now(timezone.utc))
+        )
+        db.commit()
+
+
+def _byte_order_user_search(bind: Engine):
+    # SQLite already compares bytes: its indexes are unchanged
+    if bind.dialect.name != "postgresql":
+        return
+    with bind.begin() as conn:
+        for column in ("email", "first_name", "last_name"):
+            conn.execute(text(f"DROP INDEX IF EXISTS ix_users_lower_{column}"))
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_users_lower_{column} ON users ((lower({column})) COLLATE "C")'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_users_mobile_no_c ON users (mobile_no COLLATE "C")'))
+
+
+def _notice_created_seq(bind: Engine):
+    existing = {column["name"] for column in inspect(bind).get_columns("notice")}
+    if "created_seq" not in existing:
+        with bind.begin() as conn:
+            conn.execute(text("ALTER TABLE notice ADD COLUMN created_seq BIGINT"))
+
+
+def _user_search_columns(bind: Engine):
+    existing = {column["name"] for column in inspect(bind).get_columns("users")}
+    with bind.begin() as conn:
+        for column in ("email_lower", "first_name_lower", "last_name_lower"):
+            if column not in existing:
+                conn.execute(text(f"ALTER TABLE users ADD COLUMN {column} VARCHAR"))
+    # Lowercased in Python, as the app writes them: SQLite's lower() only folds ASCII
+    users = Table(
+        "users",
+        MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("email", String),
+        Column("first_name", String),
+        Column("last_name", String),
+        Column("email_lower", String),
+        Column("first_name_lower", String),
+        Column("last_name_lower", String),
+    )
+    after = 0
+    while True:
+        with bind.begin() as conn:
+            rows = conn.execute(
+                select(users.c.id, users.c.email, users.c.first_name, users.c.last_name)
+                .where(users.c.id > after)
+                .order_by(users.c.id)
+                .limit(1000)
+            ).all()
+            if not rows:
+                break
+            conn.execute(update(users).where(users.c.id == bindparam("user_id")), [
+                {
+                    "user_id": row.id,
+                    "email_lower": row.email.lower() if row.email is not None else None,
+                    "first_name_lower": row.first_name.lower() if row.first_name is not None else None,
+                    "last_name_lower": row.last_name.lower() if row.last_name is not None else None,
+                }
+                for row in rows
+            ])
+        after = rows[-1].id
+    collate = ' COLLATE "C"' if bind.dialect.name == "postgresql" else ""
+    with bind.begin() as conn:
+        for column in ("email", "first_name", "last_name"):
+            conn.execute(text(f"DROP INDEX IF EXISTS ix_users_lower_{column}"))
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_users_{column}_lower ON users ({column}_lower{collate})"
+            ))
+
+
+def _drop_users_count(bind: Engine):
+    # GET /auth/users counts users when asked for a total
+    with bind.begin() as conn:
+        conn.execute(text("DELETE FROM counters WHERE name = 'users_count'"))
+
+
+# Append new revisions at the end; never renumber or edit applied ones
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline tables", _baseline),
+    Migration(2, "pagination, uniqueness and user search indexes", _baseline_indexes),
+    Migration(3, "notice full-text search index", _search_index),
+    Migration(4, "cache and user count counters", _counters),
+    Migration(5, "notice archive table", _notice_archive),
+    Migration(6, "notice change sequence and tombstones", _notice_change_tracking),
+    Migration(7, "byte-order user search indexes", _byte_order_user_search),
+    Migration(8, "notice creating change sequence", _notice_created_seq),
+    Migration(9, "lowercased user search columns", _user_search_columns),
+    Migration(10, "drop users_count counter", _drop_users_count),
+]
+
+HEAD = MIGRATIONS[-1].version
+
+
+def current_version(bind: Engine = engine) -> int:
+    """
+    Latest applied revision, 0 for a database that has never been migrated
+    """
+    try:
+        with bind.connect() as conn:
+            return conn.execute(select(func.max(schema_migrations.c.version))).scalar() or 0
+    except (exc.OperationalError, exc.ProgrammingError):
+        # No schema_migrations table yet
+        return 0
+
+
+def _apply_pending(bind: Engine):
+    schema_migrations.create(bind=bind, checkfirst=True)
+    version = current_version(bind)
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        started = time.perf_counter()
+        migration.upgrade(bind)
+        with bind.begin() as conn:
+            conn.execute(insert(schema_migrations).values(
+                version=migration.version, name=migration.name, applied_at=datetime.now(timezone.utc)
+            ))
+        logger.info(f"Applied migration {migration.version} ({migration.name}) in {time.perf_counter() - started:.2f}s")
+
+
+def migrate(bind: Engine = engine, timeout: float = MIGRATION_LOCK_TIMEOUT) -> int:
+    """
+    Bring the schema up to HEAD. Exactly one process applies revisions; the
+    others wait until it is done. Returns the resulting version.
+    """
+    lock = LeaderLock("schema-migrations")
+    deadline = time.monotonic() + timeout
+    while current_version(bind) < HEAD:
+        if lock.try_acquire():
+            try:
+                _apply_pending(bind)
+            finally:
+                lock.release()
+            break
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"Timed out after {timeout:.0f}s waiting for another process to migrate the database")
+        time.sleep(0.5)
+    return current_version(bind)
+
+
+def ensure_schema(bind: Engine = engine):
+    """
+    Startup check: a single version query when the schema is up to date
+    """
+    version = current_version(bind)
+    if version >= HEAD:
+        return
+    if not MIGRATE_ON_STARTUP:
+        raise RuntimeError(
+            f"Database schema is at version {version} but the app needs {HEAD}; run `python migrations.py`"
+        )
+    logger.info(f"Database schema is at version {version}, migrating to {HEAD}")
+    migrate(bind)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["status"]:
+        version = current_version()
+        print(f"Schema version {version} of {HEAD}")
+        for migration in MIGRATIONS:
+            state = "applied" if migration.version <= version else "pending"
+            print(f"  {migration.version:>3}  {state:<8} {migration.name}")
+    else:
+        print(f"✅ Schema at version {migrate()}")
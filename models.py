@@ -1,25 +1,134 @@
+from enum import Enum
+
 from db import BASE
-from sqlalchemy import Column, Integer, String, Boolean, Date, Time
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, Date, DateTime, Time, Index
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 
 class Users(BASE):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True, index=True)
-    email = Column(String, unique = True)
+    email = Column(String, unique = True, index=True)
     first_name = Column(String)
     last_name = Column(String)
-    mobile_no = Column(String)
+    mobile_no = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     admin = Column(Boolean, default=False)
+    # Prefix search on GET /auth/users, lowercased by user_search_values():
+    # SQLite's lower() only folds ASCII, so both sides are lowercased in Python
+    email_lower = Column(String)
+    first_name_lower = Column(String)
+    last_name_lower = Column(String)
+
+
+def user_search_values(email: str, first_name: str, last_name: str) -> dict:
+    """
+    The lowercased search columns for a new or changed user
+    """
+    return {
+        "email_lower": email.lower() if email is not None else None,
+        "first_name_lower": first_name.lower() if first_name is not None else None,
+        "last_name_lower": last_name.lower() if last_name is not None else None,
+    }
+
+class byte_order(FunctionElement):
+    """
+    The wrapped string expression, compared in byte (code point) order: with
+    ``COLLATE "C"`` on Postgres, whose linguistic collations ignore
+    punctuation at first, and as is on SQLite, which compares bytes already.
+    Range predicates and the indexes serving them must both use it.
+    """
+    type = String()
+    name = "byte_order"
+    inherit_cache = True
+
+
+@compiles(byte_order)
+def _compile_byte_order(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+
+@compiles(byte_order, "postgresql")
+def _compile_byte_order_postgresql(element, compiler, **kw):
+    return f'({compiler.process(element.clauses, **kw)}) COLLATE "C"'
+
+
+# Case-insensitive prefix search on GET /auth/users. mobile_no uses its unique
+# index on SQLite and ix_users_mobile_no_c (migration 7) on Postgres.
+Index('ix_users_email_lower', byte_order(Users.email_lower))
+Index('ix_users_first_name_lower', byte_order(Users.first_name_lower))
+Index('ix_users_last_name_lower', byte_order(Users.last_name_lower))
+
+# Define notice types
+class NoticeType(str, Enum):
+    maintenance = "Maintenance"
+    rent_sell = "Rent/Sell"
+    meeting = "Meeting"
+    event = "Event"
+    lost_found = "Lost & Found"
+    announcement = "General Announcement"
+    security = "Security Alert"
+    visitor = "Visitor Information"
+    payment = "Payment Reminder"
+    service = "Service"
+    emergency = "Emergency"
+    other = "Other"
 
 class Notice(BASE):
     __tablename__ = 'notice'
+    __table_args__ = (
+        # Keyset pagination on GET /notice/ walks (post_date, id), optionally within a type
+        Index('ix_notice_post_date_id', 'post_date', 'id'),
+        Index('ix_notice_type_post_date_id', 'type', 'post_date', 'id'),
+    )
 
     id = Column(Integer, primary_key=True, index = True)
     title = Column(String)
     description = Column(String)
     post_date = Column(Date)
+    event_date = Column(Date, nullable=True, index=True)
+    event_start_time = Column(Time, nullable=True)
+    event_end_time = Column(Time, nullable=True)
+    type = Column(String)
+    # Delta sync (GET /notice/changes): the notice version of the last write to this row
+    updated_at = Column(DateTime(timezone=True), nullable=True)
+    change_seq = Column(BigInteger, nullable=True, index=True)
+    # The change that created the row, so the live feed relays creates as creates
+    created_seq = Column(BigInteger, nullable=True)
+
+class NoticeArchive(BASE):
+    __tablename__ = 'notice_archive'
+
+    # Expired notices, moved here by the expiry scheduler and kept for
+    # NOTICE_ARCHIVE_RETENTION_DAYS. Own primary key: SQLite may hand out a
+    # notice id again once the highest one has been archived.
+    id = Column(Integer, primary_key=True)
+    notice_id = Column(Integer, nullable=False, index=True)
+    title = Column(String)
+    description = Column(String)
+    post_date = Column(Date)
     event_date = Column(Date, nullable=True)
     event_start_time = Column(Time, nullable=True)
     event_end_time = Column(Time, nullable=True)
     type = Column(String)
+    archived_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+class NoticeTombstone(BASE):
+    __tablename__ = 'notice_tombstones'
+
+    # Deleted and expired notices, reported by GET /notice/changes until
+    # pruned after NOTICE_TOMBSTONE_RETENTION_DAYS
+    id = Column(Integer, primary_key=True)
+    notice_id = Column(Integer, nullable=False)
+    change_seq = Column(BigInteger, nullable=False, index=True)
+    deleted_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    reason = Column(String, nullable=False)  # deleted or expired
+
+class Counter(BASE):
+    __tablename__ = 'counters'
+
+    # Named monotonically increasing values shared by all workers (cache versions, ...)
+    name = Column(String, primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
@@ -1,67 +1,38 @@
 from typing import List, Annotated, Optional
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
-from pydantic import BaseModel, Field, ConfigDict
-from sqlalchemy.orm import Session
-from datetime import date, time, datetime, timedelta
-from db import Sessionlocal
-from models import Notice, Users
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, status, BackgroundTasks, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter
+from sqlalchemy import delete, insert, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date, time, datetime, timedelta, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from models import Notice, NoticeArchive, NoticeTombstone, NoticeType
+from principals import Principal
 from auth import get_current_user  # Depends on how you structured auth
 from dependencies import get_db
-from enum import Enum
+from cache import notice_cache, NOTICE_LAST_MODIFIED, NOTICE_VERSION
+from changes import NOTICE_CHANGES_FLOOR, add_tombstones, record_notice_change, record_notice_creation, subscribe_since
+from counters import get_counter
+from expiry import active_notice_filter, scheduler as expiry_scheduler
+from events import notice_hub
+from search import search_notices_query
+from db import async_engine
+from pagination import NEXT_CURSOR_HEADER, MAX_PAGE_SIZE, encode_cursor, decode_cursor
+from serialization import FAST_JSON_RESPONSES, NOTICE_COLUMNS, dump_notice, dump_notices, dumps
+from export import ExportFormat, MEDIA_TYPES, notice_export_query, stream_export
 import logging
+import os
 # Notification service removed - notifications.py deleted
 
 router = APIRouter(prefix="/notice", tags=["Notice"])
 
-db_dependency = Annotated[Session, Depends(get_db)]
-current_user_dependency = Annotated[Users, Depends(get_current_user)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+current_user_dependency = Annotated[Principal, Depends(get_current_user)]
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Define notice types
-class NoticeType(str, Enum):
-    maintenance = "Maintenance"
-    rent_sell = "Rent/Sell"
-    meeting = "Meeting"
-    event = "Event"
-    lost_found = "Lost & Found"
-    announcement = "General Announcement"
-    security = "Security Alert"
-    visitor = "Visitor Information"
-    payment = "Payment Reminder"
-    service = "Service"
-    emergency = "Emergency"
-    other = "Other"
-
-def delete_expired_notices():
-    """
-    Delete notices that have expired (event_date is in the past)
-    """
-    try:
-        db = Sessionlocal()
-        today = date.today()
-        
-        # Find expired notices
-        expired_notices = db.query(Notice).filter(
-            Notice.event_date < today,
-            Notice.event_date.isnot(None)
-        ).all()
-        
-        if expired_notices:
-            for notice in expired_notices:
-                db.delete(notice)
-            db.commit()
-            logger.info(f"Deleted {len(expired_notices)} expired notices")
-        else:
-            logger.info("No expired notices found to delete")
-            
-    except Exception as e:
-        logger.error(f"Error deleting expired notices: {e}")
-    finally:
-        db.close()
-
 # Pydantic models
 class NoticeRequest(BaseModel):
     title: str = Field(..., min_length=3)
@@ -80,19 +51,50 @@ class NoticeResponse(BaseModel):
     event_start_time: Optional[time] = None
     event_end_time: Optional[time] = None
     type: str
-    
-    class Config:
-        from_attributes = True
-        # Handle None values properly
-        json_encoders = {
-            date: lambda v: v.isoformat() if v else None,
-            time: lambda v: v.isoformat() if v else None,
-        }
+
+    model_config = ConfigDict(from_attributes=True)
+
+notice_list_adapter = TypeAdapter(List[NoticeResponse])
+
+class NoticeChangesResponse(BaseModel):
+    cursor: int
+    reset: bool
+    notices: List[NoticeResponse]
+    deleted: List[int]
+
+class ArchivedNoticeResponse(BaseModel):
+    id: int
+    notice_id: int
+    title: str
+    description: str
+    post_date: date
+    event_date: Optional[date] = None
+    event_start_time: Optional[time] = None
+    event_end_time: Optional[time] = None
+    type: str
+    archived_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+class NoticeBulkUpdateRequest(NoticeRequest):
+    id: int
+
+class BulkItemResult(BaseModel):
+    index: int
+    id: int
+    status: str  # created, updated, deleted or not_found
+
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "10000"))
+
+def _check_bulk_request(items: list, current_user: Principal):
+    if not current_user.admin:
+        raise HTTPException(status_code=403, detail="Only admins can manage notices in bulk")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ITEMS} items per bulk request")
 
 @router.post("/", response_model=NoticeResponse)
-def create_notice(
+async def create_notice(
     notice_request: NoticeRequest,
-    background_tasks: BackgroundTasks,
     db: db_dependency,
     current_user: current_user_dependency
 ):
@@ -101,78 +103,397 @@ def create_notice(
 
     notice_data = notice_request.dict()
     notice_data["post_date"] = date.today()
+    notice_data.update(await db.run_sync(record_notice_creation))
     notice = Notice(**notice_data)
     db.add(notice)
-    db.commit()
-    db.refresh(notice)
-    
-    # Add background task to check for expired notices
-    background_tasks.add_task(delete_expired_notices)
+    await db.commit()
+    notice_cache.invalidate()
+    await db.refresh(notice)
+    notice_hub.publish("created", NoticeResponse.model_validate(notice).model_dump(mode="json"), notice.change_seq)
     
     logger.info(f"Notice created by {current_user.email}.")
     
     return notice
 
-@router.get("/", response_model=List[NoticeResponse])
-def get_all_notices(db: db_dependency):
-    # Check for expired notices before returning the list
-    delete_expired_notices()
-    notices = db.query(Notice).all()
-    
-    # Convert to response models manually to handle NULL values
-    response_notices = []
-    for notice in notices:
-        notice_dict = {
-            "id": notice.id,
-            "title": notice.title,
-            "description": notice.description,
-            "post_date": notice.post_date,
-            "event_date": notice.event_date,
-            "event_start_time": notice.event_start_time,
-            "event_end_time": notice.event_end_time,
-            "type": notice.type
-        }
-        response_notices.append(NoticeResponse(**notice_dict))
+def _encode_notices(rows) -> bytes:
+    """
+    JSON array for rows selected with NOTICE_COLUMNS
+    """
+    if FAST_JSON_RESPONSES:
+        return dump_notices(rows)
+    return notice_list_adapter.dump_json(notice_list_adapter.validate_python(rows, from_attributes=True))
+
+async def _list_notices(db: AsyncSession, limit, cursor, type, event_from, event_to, upcoming):
+    # Expired notices are hidden here and archived by the expiry scheduler
+    query = select(*NOTICE_COLUMNS).where(active_notice_filter())
+    if type is not None:
+        query = query.where(Notice.type == type.value)
+    if event_from is not None:
+        query = query.where(Notice.event_date >= event_from)
+    if event_to is not None:
+        query = query.where(Notice.event_date <= event_to)
+    if upcoming:
+        query = query.where(Notice.event_date >= date.today())
+    if cursor:
+        post_date, notice_id = decode_cursor(cursor, 2)
+        try:
+            after = (date.fromisoformat(post_date), int(notice_id))
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(tuple_(Notice.post_date, Notice.id) < after)
+
+    query = query.order_by(Notice.post_date.desc(), Notice.id.desc())
+    headers = {}
+    if limit is not None:
+        # Fetch one extra row to know whether another page exists
+        rows = (await db.execute(query.limit(limit + 1))).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            headers[NEXT_CURSOR_HEADER] = encode_cursor(last.post_date.isoformat(), last.id)
+    else:
+        rows = (await db.execute(query)).all()
     
-    return response_notices
+    return _encode_notices(rows), headers
+
+def _etag(version: int) -> str:
+    # Expiry hides notices at midnight, so the day is part of the version
+    return f'W/"{version}-{date.today().isoformat()}"'
+
+def _not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+async def _last_modified(db: AsyncSession, version: int) -> int:
+    """
+    Unix time of the last notice change, cached alongside the responses
+    """
+    key = ("last_modified",)
+    changed_at = notice_cache.get(key)
+    if changed_at is None:
+        changed_at = await db.run_sync(get_counter, NOTICE_LAST_MODIFIED)
+        notice_cache.set(key, changed_at, version)
+    # Expiry hides notices at midnight even when nothing was written
+    return max(changed_at, int(datetime.combine(date.today(), time.min).timestamp()))
+
+def _not_modified_since(request: Request, last_modified: int) -> bool:
+    # If-None-Match takes precedence; ETags also catch changes within one second
+    if_modified_since = request.headers.get("if-modified-since")
+    if not if_modified_since or "if-none-match" in request.headers:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return last_modified <= since.timestamp()
+
+async def _cached_json(request: Request, db: AsyncSession, key, produce) -> Response:
+    """
+    Serve a JSON body from notice_cache, calling `produce()` on a miss.
+    `produce` returns (body bytes, extra headers).
+    """
+    version = await notice_cache.version(db)
+    last_modified = await _last_modified(db, version)
+    headers = {
+        "ETag": _etag(version),
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+    if _not_modified(request, headers["ETag"]) or _not_modified_since(request, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    key = (date.today(),) + key
+    cached = notice_cache.get(key)
+    if cached is None:
+        cached = await produce()
+        notice_cache.set(key, cached, version)
+    body, extra_headers = cached
+    headers.update(extra_headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@router.post("/bulk", response_model=List[BulkItemResult])
+async def bulk_create_notices(
+    notice_requests: List[NoticeRequest],
+    db: db_dependency,
+    current_user: current_user_dependency
+):
+    """
+    Create many notices in one transaction with a single multi-row INSERT
+    """
+    _check_bulk_request(notice_requests, current_user)
+    if not notice_requests:
+        return []
+
+    today = date.today()
+    change = await db.run_sync(record_notice_creation)
+    rows = [dict(notice_request.dict(), post_date=today, **change) for notice_request in notice_requests]
+    ids = (await db.scalars(insert(Notice).returning(Notice.id, sort_by_parameter_order=True), rows)).all()
+    await db.commit()
+    notice_cache.invalidate()
+    notice_hub.publish("bulk_created", {"ids": ids}, change["change_seq"])
+
+    logger.info(f"{len(ids)} notices created in bulk by {current_user.email}.")
+    return [BulkItemResult(index=i, id=notice_id, status="created") for i, notice_id in enumerate(ids)]
+
+@router.patch("/bulk", response_model=List[BulkItemResult])
+async def bulk_update_notices(
+    notice_requests: List[NoticeBulkUpdateRequest],
+    db: db_dependency,
+    current_user: current_user_dependency
+):
+    """
+    Replace the fields of many notices in one transaction (executemany UPDATE
+    by primary key); unknown ids are reported as not_found
+    """
+    _check_bulk_request(notice_requests, current_user)
+    requested_ids = {notice_request.id for notice_request in notice_requests}
+    existing_ids = set((await db.scalars(select(Notice.id).where(Notice.id.in_(requested_ids)))).all())
+
+    rows = [notice_request.dict() for notice_request in notice_requests if notice_request.id in existing_ids]
+    if rows:
+        change = await db.run_sync(record_notice_change)
+        await db.execute(update(Notice), [dict(row, **change) for row in rows])
+        await db.commit()
+        notice_cache.invalidate()
+        notice_hub.publish("bulk_updated", {"ids": sorted(existing_ids)}, change["change_seq"])
+
+    return [
+        BulkItemResult(
+            index=i,
+            id=notice_request.id,
+            status="updated" if notice_request.id in existing_ids else "not_found",
+        )
+        for i, notice_request in enumerate(notice_requests)
+    ]
+
+@router.delete("/bulk", response_model=List[BulkItemResult])
+async def bulk_delete_notices(
+    notice_ids: Annotated[List[int], Body()],
+    db: db_dependency,
+    current_user: current_user_dependency
+):
+    """
+    Delete many notices by id with a single DELETE; unknown ids are reported
+    as not_found
+    """
+    _check_bulk_request(notice_ids, current_user)
+    deleted_ids = set()
+    if notice_ids:
+        deleted_ids = set((await db.scalars(
+            delete(Notice)
+            .where(Notice.id.in_(set(notice_ids)))
+            .returning(Notice.id)
+            .execution_options(synchronize_session=False)
+        )).all())
+    if deleted_ids:
+        change = await db.run_sync(record_notice_change)
+        await db.run_sync(add_tombstones, sorted(deleted_ids), change, "deleted")
+        await db.commit()
+        notice_cache.invalidate()
+        notice_hub.publish("bulk_deleted", {"ids": sorted(deleted_ids)}, change["change_seq"])
+
+    return [
+        BulkItemResult(index=i, id=notice_id, status="deleted" if notice_id in deleted_ids else "not_found")
+        for i, notice_id in enumerate(notice_ids)
+    ]
+
+@router.get("/", response_model=List[NoticeResponse])
+async def get_all_notices(
+    request: Request,
+    db: db_dependency,
+    limit: Annotated[Optional[int], Query(ge=1, le=MAX_PAGE_SIZE)] = None,
+    cursor: Optional[str] = None,
+    type: Optional[NoticeType] = None,
+    event_from: Optional[date] = None,
+    event_to: Optional[date] = None,
+    upcoming: bool = False,
+):
+    """
+    List notices newest first. Pass `limit` to page through the board; the
+    cursor for the next page is returned in the X-Next-Cursor header.
+    Responses carry an ETag and Last-Modified; send them back in
+    If-None-Match or If-Modified-Since to get a 304.
+    """
+    return await _cached_json(
+        request, db,
+        ("list", limit, cursor, type, event_from, event_to, upcoming),
+        lambda: _list_notices(db, limit, cursor, type, event_from, event_to, upcoming),
+    )
+
+@router.get("/search", response_model=List[NoticeResponse])
+async def search_notices(
+    request: Request,
+    db: db_dependency,
+    q: Annotated[str, Query(min_length=1, max_length=200)],
+    type: Optional[NoticeType] = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = 20,
+    offset: Annotated[int, Query(ge=0)] = 0,
+):
+    """
+    Full-text search over notice titles and descriptions, best match first
+    """
+    async def produce():
+        query = search_notices_query(async_engine.dialect.name, q)
+        if query is None:
+            return b"[]", {}
+        query = query.with_only_columns(*NOTICE_COLUMNS).where(active_notice_filter())
+        if type is not None:
+            query = query.where(Notice.type == type.value)
+        rows = (await db.execute(query.limit(limit).offset(offset))).all()
+        return _encode_notices(rows), {}
+
+    return await _cached_json(request, db, ("search", q, type, limit, offset), produce)
+
+@router.get("/stream", response_class=StreamingResponse)
+async def stream_notices(last_event_id: Annotated[Optional[str], Header()] = None):
+    """
+    Server-Sent Events feed of notice changes: `created`, `updated`,
+    `deleted`, `bulk_created`, `bulk_updated`, `bulk_deleted` and `expired`
+    events, plus `reset` when the client missed too much and should reload
+    the board. Event ids are change sequences: a reconnect to any worker
+    resumes from Last-Event-ID through the change log. Changes handled by
+    other workers are relayed from the change log within EVENT_RELAY_SECONDS.
+    """
+    subscriber = await subscribe_since(notice_hub, last_event_id)
+    if subscriber is None:
+        raise HTTPException(status_code=503, detail="Too many live feed subscribers", headers={"Retry-After": "30"})
+    return StreamingResponse(
+        notice_hub.stream(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.get("/export", response_class=StreamingResponse)
+async def export_notices(current_user: current_user_dependency, format: ExportFormat = ExportFormat.ndjson):
+    """
+    Stream every notice as NDJSON or CSV, in constant memory - Admin only
+    """
+    if not current_user.admin:
+        raise HTTPException(status_code=403, detail="Only admins can export notices")
+    return StreamingResponse(
+        stream_export(notice_export_query(), format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="notices-{date.today().isoformat()}.{format.value}"'},
+    )
+
+def _changes_json(cursor: int, reset: bool, notices: bytes = b"[]", deleted: List[int] = ()) -> Response:
+    body = b'{"cursor":%d,"reset":%s,"notices":%s,"deleted":%s}' % (
+        cursor, b"true" if reset else b"false", notices, dumps(list(deleted))
+    )
+    return Response(content=body, media_type="application/json")
+
+@router.get("/changes", response_model=NoticeChangesResponse)
+async def get_notice_changes(db: db_dependency, since: Annotated[int, Query(ge=0)] = 0):
+    """
+    Delta sync: notices created or updated and ids deleted since the `cursor`
+    returned by a previous call (pass it as `since`, 0 for the first sync).
+    Apply `deleted` before `notices`. When `reset` is true, `notices` is the
+    whole board and replaces the local copy. Expired notices show up in
+    `deleted` once the expiry scheduler archives them.
+    """
+    if since and since == await notice_cache.version(db):
+        # Nothing new: no query beyond the (cached) version check
+        return _changes_json(since, False)
+    # Read before the rows: anything up to this version has committed
+    version = await db.run_sync(get_counter, NOTICE_VERSION)
+    if since == version:
+        return _changes_json(since, False)
+    floor = await db.run_sync(get_counter, NOTICE_CHANGES_FLOOR)
+    # A cursor below the floor missed pruned deletions; one above the version is from another database
+    reset = since == 0 or since < floor or since > version
+
+    query = select(*NOTICE_COLUMNS).where(active_notice_filter())
+    if not reset:
+        query = query.where(Notice.change_seq > since)
+    rows = (await db.execute(query.order_by(Notice.id))).all()
+    deleted = []
+    if not reset:
+        changed_ids = {row.id for row in rows}
+        tombstoned_ids = await db.scalars(
+            select(NoticeTombstone.notice_id).where(NoticeTombstone.change_seq > since)
+        )
+        # An id deleted and then reused (SQLite) is live again
+        deleted = sorted(set(tombstoned_ids) - changed_ids)
+    return _changes_json(version, reset, _encode_notices(rows), deleted)
+
+@router.get("/archive", response_model=List[ArchivedNoticeResponse])
+async def get_archived_notices(
+    response: Response,
+    db: db_dependency,
+    current_user: current_user_dependency,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = 50,
+    cursor: Optional[str] = None,
+    type: Optional[NoticeType] = None,
+):
+    """
+    Expired notices, most recently archived first - Admin only. The cursor
+    for the next page is returned in the X-Next-Cursor header.
+    """
+    if not current_user.admin:
+        raise HTTPException(status_code=403, detail="Only admins can read the notice archive")
+    query = select(NoticeArchive)
+    if type is not None:
+        query = query.where(NoticeArchive.type == type.value)
+    if cursor:
+        (archive_id,) = decode_cursor(cursor, 1)
+        if not isinstance(archive_id, int):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(NoticeArchive.id < archive_id)
+    # Archive ids grow with archiving time
+    rows = (await db.scalars(query.order_by(NoticeArchive.id.desc()).limit(limit + 1))).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1].id)
+    return rows
 
 @router.get("/{notice_id}", response_model=NoticeResponse)
-def get_notice_by_id(notice_id: int, db: db_dependency):
-    notice = db.query(Notice).filter(Notice.id == notice_id).first()
-    if not notice:
-        raise HTTPException(status_code=404, detail="Notice not found")
-    return notice
+async def get_notice_by_id(notice_id: int, request: Request, db: db_dependency):
+    async def produce():
+        row = (await db.execute(
+            select(*NOTICE_COLUMNS).where(Notice.id == notice_id, active_notice_filter())
+        )).first()
+        if not row:
+            raise HTTPException(status_code=404, detail="Notice not found")
+        if FAST_JSON_RESPONSES:
+            return dump_notice(row), {}
+        return NoticeResponse.model_validate(row).model_dump_json().encode(), {}
+
+    return await _cached_json(request, db, ("id", notice_id), produce)
 
 @router.put("/{notice_id}", response_model=NoticeResponse)
-def update_notice(
+async def update_notice(
     notice_id: int,
     notice_request: NoticeRequest,
-    background_tasks: BackgroundTasks,
     db: db_dependency,
     current_user: current_user_dependency
 ):
     if not current_user.admin:
         raise HTTPException(status_code=403, detail="Only admins can update notices")
 
-    notice = db.query(Notice).filter(Notice.id == notice_id).first()
+    notice = await db.get(Notice, notice_id)
     if not notice:
         raise HTTPException(status_code=404, detail="Notice not found")
 
     # Only update fields from NoticeRequest (not post_date)
     update_data = notice_request.dict()
+    update_data.update(await db.run_sync(record_notice_change))
     for key, value in update_data.items():
         setattr(notice, key, value)
     
-    db.commit()
-    db.refresh(notice)
-    
-    # Add background task to check for expired notices
-    background_tasks.add_task(delete_expired_notices)
+    await db.commit()
+    notice_cache.invalidate()
+    await db.refresh(notice)
+    notice_hub.publish("updated", NoticeResponse.model_validate(notice).model_dump(mode="json"), notice.change_seq)
     
     return notice
 
 @router.delete("/{notice_id}")
-def delete_notice(
+async def delete_notice(
     notice_id: int,
     db: db_dependency,
     current_user: current_user_dependency
@@ -180,25 +501,29 @@ def delete_notice(
     if not current_user.admin:
         raise HTTPException(status_code=403, detail="Only admins can delete notices")
 
-    notice = db.query(Notice).filter(Notice.id == notice_id).first()
+    notice = await db.get(Notice, notice_id)
     if not notice:
         raise HTTPException(status_code=404, detail="Notice not found")
 
-    db.delete(notice)
-    db.commit()
+    await db.delete(notice)
+    change = await db.run_sync(record_notice_change)
+    await db.run_sync(add_tombstones, [notice_id], change, "deleted")
+    await db.commit()
+    notice_cache.invalidate()
+    notice_hub.publish("deleted", {"id": notice_id}, change["change_seq"])
     
     return {"message": "Notice deleted successfully"}
 
 @router.post("/cleanup-expired")
-def cleanup_expired_notices(
+async def cleanup_expired_notices(
     background_tasks: BackgroundTasks,
     current_user: current_user_dependency
 ):
     if not current_user.admin:
         raise HTTPException(status_code=403, detail="Only admins can trigger cleanup")
     
-    # Add background task to delete expired notices
-    background_tasks.add_task(delete_expired_notices)
+    # Archive expired notices in the background, in this worker
+    background_tasks.add_task(expiry_scheduler.trigger)
     
     return {"message": "Cleanup task scheduled"}
 
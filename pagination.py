@@ -0,0 +1,37 @@
+"""
+Helpers for keyset (cursor) pagination.
+
+List endpoints keep returning a plain JSON array so existing clients keep
+working; the cursor for the next page travels in the ``X-Next-Cursor``
+response header and is absent on the last page.
+"""
+import base64
+import binascii
+import json
+
+from fastapi import HTTPException
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(*values) -> str:
+    """
+    Pack the sort key of the last row of a page into an opaque, URL-safe token
+    """
+    raw = json.dumps(values, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    """
+    Unpack a token produced by encode_cursor() holding ``size`` values
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
@@ -0,0 +1,143 @@
+"""
+Password hashing and verification off the request path.
+
+bcrypt is deliberately slow and holds the GIL while it runs, so doing it
+inline lets a burst of logins stall every other request on the worker. Here
+it runs in a small dedicated process pool:
+
+- at most PASSWORD_HASH_WORKERS hashes run at once, further calls wait;
+- once PASSWORD_HASH_MAX_QUEUE calls are waiting, new ones fail fast with
+  PasswordHasherBusy instead of piling up;
+- the bcrypt cost is BCRYPT_ROUNDS; hashes made with another cost are
+  upgraded on the next successful login (CryptContext.needs_update).
+
+Set PASSWORD_HASH_WORKERS=0 to hash in the threadpool instead.
+
+This module is imported by the pool's child processes, so it must stay free of
+app and database imports.
+"""
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+from starlette.concurrency import run_in_threadpool
+
+from metrics import password_hash_duration_seconds, registry
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+
+bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Too many password operations are already waiting
+    """
+
+
+def _hash(password: str) -> str:
+    return bcrypt_context.hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    # Returns a replacement hash when the stored one uses an outdated cost
+    return bcrypt_context.verify_and_update(password, hashed_password)
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_queue: int = PASSWORD_HASH_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "busy_seconds": round(self.busy_seconds, 3),
+        }
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Created lazily so each (forked) server worker owns its own pool;
+        # spawn avoids forking a process that already runs threads
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(max(self.workers, 1))
+        if self._semaphore.locked() and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            if self.workers > 0:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._get_executor(), fn, *args)
+            return await run_in_threadpool(fn, *args)
+        finally:
+            self.busy_seconds += time.perf_counter() - started
+            self.in_flight -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._semaphore = None
+
+
+password_hasher = PasswordHasher()
+
+
+_queue_gauges = {
+    name: registry.gauge(f"password_hash_{name}", f"Password hasher {name.replace('_', ' ')}")
+    for name in ("in_flight", "queued", "rejected")
+}
+
+
+def _collect_metrics():
+    stats = password_hasher.stats()
+    for name, gauge in _queue_gauges.items():
+        gauge.set(stats[name])
+
+
+registry.on_collect(_collect_metrics)
+
+
+async def hash_password(password: str) -> str:
+    with password_hash_duration_seconds.time("hash"):
+        return await password_hasher.run(_hash, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Check a password; the second item is a new hash to store, if any
+    """
+    with password_hash_duration_seconds.time("verify"):
+        return await password_hasher.run(_verify, password, hashed_password)
@@ -0,0 +1,52 @@
+"""
+Cache of authenticated principals.
+
+get_current_user() runs on every authenticated request; resolving the JWT
+subject to a user through this cache avoids a Users lookup per call. Entries
+expire after PRINCIPAL_CACHE_TTL seconds and are dropped in every worker when
+the ``users_version`` counter changes, which anything that changes or removes
+a user (make-admin endpoint, make_admin.py, clear_tables.py) must bump.
+"""
+import os
+from dataclasses import dataclass
+
+from sqlalchemy.orm import Session
+
+from cache import VersionedCache
+from counters import bump_counter
+from models import Users
+
+USERS_VERSION = "users_version"
+
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "300"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
+
+@dataclass(frozen=True)
+class Principal:
+    """
+    The authenticated user, without secrets such as the password hash
+    """
+    id: int
+    email: str
+    first_name: str
+    last_name: str
+    mobile_no: str
+    admin: bool
+
+
+# The Principal fields, and nothing else (no password hash)
+USER_COLUMNS = (Users.id, Users.email, Users.first_name, Users.last_name, Users.mobile_no, Users.admin)
+
+principal_cache = VersionedCache(
+    USERS_VERSION, max_entries=PRINCIPAL_CACHE_SIZE, entry_ttl=PRINCIPAL_CACHE_TTL
+)
+
+
+def bump_users_version(db: Session):
+    """
+    Record a user change in the current transaction. Call
+    principal_cache.invalidate() once it has committed.
+    """
+    bump_counter(db, USERS_VERSION)
+
@@ -0,0 +1,470 @@
+"""
+Opt-in request profiling and slow-query capture, for finding out where a
+slow endpoint spends its time (SQL, ORM loading, pydantic, JSON encoding).
+
+- Request profiles: with ``PROFILING_ENABLED``, an admin request carrying
+  ``X-Profile: 1`` runs under cProfile; ``PROFILE_SAMPLE_RATE`` profiles that
+  fraction of all requests as well. The response names the profile in
+  ``X-Profile-Id``; the last ``PROFILE_BUFFER_SIZE`` profiles are kept in
+  memory and can be listed and downloaded from ``/admin/profiles`` (pstats
+  file, or text). One request is profiled at a time per worker, and requests
+  the worker serves concurrently show up in the same profile. Profiling
+  stops once the response body has been sent; streaming endpoints (the live
+  feed and exports) are never profiled.
+- Slow queries: statements slower than ``SLOW_QUERY_THRESHOLD_MS`` are
+  recorded from the engines' ``before_cursor_execute``/``after_cursor_execute``
+  events with their parameter shape (types, never values), the route that
+  ran them and, with ``SLOW_QUERY_EXPLAIN``, the plan of each distinct
+  SELECT. ``/admin/slow-queries`` lists the top offenders.
+
+Everything is per worker and in memory, like the metrics.
+"""
+import cProfile
+import io
+import itertools
+import logging
+import marshal
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from enum import Enum
+from typing import Annotated, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy import event
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from auth import get_current_user
+from db import AsyncSessionlocal, async_engine, engine
+from metrics import current_route
+from principals import Principal
+
+logger = logging.getLogger(__name__)
+
+# Let admins profile a request with the X-Profile header
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+# Fraction of all requests profiled, whoever sends them
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "20"))
+# 0 disables the slow-query log
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "0"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() in ("1", "true", "yes")
+SLOW_QUERY_MAX_STATEMENTS = int(os.getenv("SLOW_QUERY_MAX_STATEMENTS", "500"))
+SLOW_QUERY_RECENT_SIZE = int(os.getenv("SLOW_QUERY_RECENT_SIZE", "100"))
+
+PROFILE_HEADER = "x-profile"
+# Long-lived responses: a profile would stay enabled for the whole connection
+UNPROFILED_PATHS = frozenset({"/notice/stream", "/notice/export", "/auth/users/export"})
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+router = APIRouter(prefix="/admin", tags=["Admin"])
+
+
+# ----------------------------------------
+# Request profiles
+# ----------------------------------------
+
+@dataclass
+class ProfileRecord:
+    id: int
+    method: str
+    path: str
+    trigger: str  # header or sample
+    started_at: datetime
+    profile: cProfile.Profile
+    status: int = 0
+    duration_ms: float = 0.0
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "duration_ms": round(self.duration_ms, 3),
+            "trigger": self.trigger,
+            "started_at": self.started_at.isoformat(),
+        }
+
+
+class ProfileStore:
+    """
+    Ring buffer of the most recent request profiles
+    """
+
+    def __init__(self, size: int = PROFILE_BUFFER_SIZE):
+        self._records = deque(maxlen=size)
+        self._ids = itertools.count(1)
+
+    def new_id(self) -> int:
+        return next(self._ids)
+
+    def add(self, record: ProfileRecord):
+        self._records.append(record)
+
+    def get(self, profile_id: int) -> Optional[ProfileRecord]:
+        for record in self._records:
+            if record.id == profile_id:
+                return record
+        return None
+
+    def records(self) -> List[ProfileRecord]:
+        return list(self._records)
+
+
+profile_store = ProfileStore()
+
+
+async def _is_admin(headers: Headers) -> bool:
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    async with AsyncSessionlocal() as db:
+        try:
+            principal = await get_current_user(token, db)
+        except HTTPException:
+            return False
+    return principal.admin
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: ASGIApp, store: ProfileStore = profile_store):
+        self.app = app
+        self.store = store
+        # cProfile cannot nest: one profiled request at a time
+        self._busy = False
+
+    async def _trigger(self, scope: Scope) -> Optional[str]:
+        if not PROFILING_ENABLED:
+            return None
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return "sample"
+        headers = Headers(scope=scope)
+        if headers.get(PROFILE_HEADER, "").lower() in ("1", "true", "yes") and await _is_admin(headers):
+            return "header"
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or self._busy or scope["path"] in UNPROFILED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        trigger = await self._trigger(scope)
+        if trigger is None or self._busy:
+            await self.app(scope, receive, send)
+            return
+
+        record = ProfileRecord(
+            id=self.store.new_id(),
+            method=scope["method"],
+            path=scope["path"],
+            trigger=trigger,
+            started_at=datetime.now(timezone.utc),
+            profile=cProfile.Profile(),
+        )
+
+        started = time.perf_counter()
+        finished = False
+
+        def finish():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            record.profile.disable()
+            record.duration_ms = (time.perf_counter() - started) * 1000
+            self._busy = False
+            self.store.add(record)
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                record.status = message["status"]
+                MutableHeaders(scope=message)[PROFILE_ID_HEADER] = str(record.id)
+            await send(message)
+            # Stop at the end of the body, not after background tasks
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        self._busy = True
+        record.profile.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish()
+
+
+# ----------------------------------------
+# Slow queries
+# ----------------------------------------
+
+# Expanded IN lists and multi-row VALUES vary in length; fold them so each
+# statement shape is recorded once
+_PLACEHOLDER_LIST = re.compile(r"\(\s*(?:\?|%s|%\(\w+\)s|\$\d+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|\$\d+))+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+_EXPLAIN_PREFIX = {"sqlite": "EXPLAIN QUERY PLAN ", "postgresql": "EXPLAIN "}
+
+
+def normalize_statement(statement: str) -> str:
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    return _PLACEHOLDER_LIST.sub("(...)", statement)[:2000]
+
+
+def parameters_shape(parameters, executemany: bool) -> str:
+    """
+    Parameter types without their values, e.g. ``(int, str)`` or ``100 x {id: int}``
+    """
+    if executemany:
+        rows = list(parameters or ())
+        return f"{len(rows)} x {parameters_shape(rows[0], False)}" if rows else "0 x ()"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    if isinstance(parameters, (list, tuple)):
+        return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+    return type(parameters).__name__
+
+
+@dataclass
+class SlowStatement:
+    statement: str
+    count: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    last_route: str = ""
+    last_parameters: str = ""
+    last_seen: float = 0.0
+    explain: Optional[List[str]] = None
+
+    def summary(self) -> dict:
+        return {
+            "statement": self.statement,
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "last_route": self.last_route,
+            "last_parameters": self.last_parameters,
+            "last_seen": datetime.fromtimestamp(self.last_seen, timezone.utc).isoformat(),
+            "explain": self.explain,
+        }
+
+
+class SlowQueryLog:
+    """
+    Aggregated slow statements (at most ``max_statements``) and the most
+    recent slow runs. The engine events fire on the event loop and in
+    threads alike, hence the lock.
+    """
+
+    def __init__(
+        self,
+        threshold_ms: float = SLOW_QUERY_THRESHOLD_MS,
+        max_statements: int = SLOW_QUERY_MAX_STATEMENTS,
+        explain: bool = SLOW_QUERY_EXPLAIN,
+        recent_size: int = SLOW_QUERY_RECENT_SIZE,
+    ):
+        self.threshold_ms = threshold_ms
+        self.max_statements = max_statements
+        self.explain = explain
+        self.statements: Dict[str, SlowStatement] = {}
+        self.recent = deque(maxlen=recent_size)
+        self._lock = threading.Lock()
+
+    def install(self, sync_engine):
+        event.listen(sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(sync_engine, "handle_error", self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_started", []).append(time.perf_counter())
+
+    def _handle_error(self, exception_context):
+        conn = exception_context.connection
+        started = conn.info.get("slow_query_started") if conn is not None else None
+        if started:
+            started.pop()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info["slow_query_started"].pop()) * 1000
+        if elapsed_ms < self.threshold_ms:
+            return
+        key = normalize_statement(statement)
+        shape = parameters_shape(parameters, executemany)
+        route = current_route.get()
+        with self._lock:
+            entry = self.statements.get(key)
+            if entry is None:
+                if len(self.statements) >= self.max_statements:
+                    # Make room by forgetting the statement that costs least in total
+                    del self.statements[min(self.statements.values(), key=lambda s: s.total_ms).statement]
+                entry = self.statements[key] = SlowStatement(key)
+                needs_explain = self.explain and not executemany and key.upper().startswith(("SELECT", "WITH"))
+            else:
+                needs_explain = False
+            entry.count += 1
+            entry.total_ms += elapsed_ms
+            entry.max_ms = max(entry.max_ms, elapsed_ms)
+            entry.last_route = route
+            entry.last_parameters = shape
+            entry.last_seen = time.time()
+            self.recent.append({
+                "statement": key,
+                "duration_ms": round(elapsed_ms, 3),
+                "route": route,
+                "parameters": shape,
+                "at": datetime.now(timezone.utc).isoformat(),
+            })
+        logger.warning(f"Slow query ({elapsed_ms:.1f} ms, {route}): {key[:200]}")
+        if needs_explain:
+            entry.explain = self._explain(conn, statement, parameters)
+
+    def _explain(self, conn, statement: str, parameters) -> List[str]:
+        prefix = _EXPLAIN_PREFIX.get(conn.dialect.name)
+        if prefix is None:
+            return []
+        # A raw DBAPI cursor on the same connection: no events, no recursion.
+        # On Postgres a failed statement aborts the whole transaction, so the
+        # EXPLAIN runs in a savepoint that is rolled back if it fails.
+        savepoint = conn.dialect.name == "postgresql"
+        cursor = conn.connection.cursor()
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(prefix + statement, parameters)
+                plan = [" ".join(str(value) for value in row) for row in cursor.fetchall()]
+            except Exception as e:
+                if savepoint:
+                    cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                plan = [f"EXPLAIN failed: {e}"]
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        except Exception as e:
+            # No transaction to protect (or savepoints unavailable): skip the plan
+            return [f"EXPLAIN skipped: {e}"]
+        finally:
+            cursor.close()
+
+    def top(self, limit: int, sort: str) -> List[dict]:
+        with self._lock:
+            entries = sorted(self.statements.values(), key=lambda s: getattr(s, sort), reverse=True)[:limit]
+            return [entry.summary() for entry in entries]
+
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+            self.recent.clear()
+
+
+slow_query_log = SlowQueryLog()
+
+if SLOW_QUERY_THRESHOLD_MS > 0:
+    slow_query_log.install(engine)
+    slow_query_log.install(async_engine.sync_engine)
+
+
+# ----------------------------------------
+# Admin endpoints
+# ----------------------------------------
+
+def _require_admin(current_user: Annotated[Principal, Depends(get_current_user)]) -> Principal:
+    if not current_user.admin:
+        raise HTTPException(status_code=403, detail="Only admins can read profiling data")
+    return current_user
+
+
+admin_dependency = Annotated[Principal, Depends(_require_admin)]
+
+
+class ProfileFormat(str, Enum):
+    text = "text"
+    pstats = "pstats"
+
+
+class ProfileSort(str, Enum):
+    recent = "recent"
+    duration = "duration"
+
+
+class StatsSort(str, Enum):
+    cumulative = "cumulative"
+    tottime = "tottime"
+    ncalls = "ncalls"
+
+
+class SlowQuerySort(str, Enum):
+    total_ms = "total_ms"
+    max_ms = "max_ms"
+    count = "count"
+
+
+@router.get("/profiles")
+async def list_profiles(current_user: admin_dependency, sort: ProfileSort = ProfileSort.recent):
+    """
+    Stored request profiles, newest (or slowest) first - Admin only
+    """
+    records = profile_store.records()
+    if sort == ProfileSort.duration:
+        records.sort(key=lambda record: record.duration_ms, reverse=True)
+    else:
+        records.reverse()
+    return [record.summary() for record in records]
+
+
+@router.get("/profiles/{profile_id}")
+async def get_profile(
+    profile_id: int,
+    current_user: admin_dependency,
+    format: ProfileFormat = ProfileFormat.text,
+    sort: StatsSort = StatsSort.cumulative,
+    limit: Annotated[int, Query(ge=1, le=500)] = 50,
+):
+    """
+    One profile as pstats text, or as a .pstats file for snakeviz / pstats
+    """
+    record = profile_store.get(profile_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == ProfileFormat.pstats:
+        record.profile.create_stats()
+        return Response(
+            content=marshal.dumps(record.profile.stats),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.pstats"'},
+        )
+    out = io.StringIO()
+    out.write(f"{record.method} {record.path} -> {record.status} in {record.duration_ms:.1f} ms\n")
+    pstats.Stats(record.profile, stream=out).sort_stats(sort.value).print_stats(limit)
+    return Response(content=out.getvalue(), media_type="text/plain; charset=utf-8")
+
+
+@router.get("/slow-queries")
+async def get_slow_queries(
+    current_user: admin_dependency,
+    sort: SlowQuerySort = SlowQuerySort.total_ms,
+    limit: Annotated[int, Query(ge=1, le=500)] = 20,
+):
+    """
+    Top offending SQL statements by total time, worst single run or count,
+    and the most recent slow runs - Admin only
+    """
+    return {
+        "threshold_ms": slow_query_log.threshold_ms if SLOW_QUERY_THRESHOLD_MS > 0 else None,
+        "statements": slow_query_log.top(limit, sort.value),
+        "recent": list(reversed(slow_query_log.recent)),
+    }
+
+
+@router.delete("/slow-queries")
+async def reset_slow_queries(current_user: admin_dependency):
+    """
+    Forget the recorded slow queries - Admin only
+    """
+    slow_query_log.reset()
+    return {"message": "Slow query log cleared"}
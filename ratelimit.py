@@ -0,0 +1,360 @@
+"""
+Token-bucket rate limiting and load shedding.
+
+bcrypt makes every login and registration cost tens of milliseconds of CPU,
+so a single client retrying credentials can starve the worker. Two layers
+keep reads fast under that kind of abuse:
+
+- Rate limits: per client IP for POST /auth/login and /auth/register
+  (``RATE_LIMIT_AUTH_*``) and for every other write (``RATE_LIMIT_WRITE_*``),
+  plus per account for login attempts (``RATE_LIMIT_LOGIN_ACCOUNT_*``,
+  checked in auth.login). An exhausted bucket answers 429 with Retry-After.
+- Load shedding: once ``LOAD_SHED_MAX_IN_FLIGHT`` requests are in progress
+  in this worker, or ``LOAD_SHED_MAX_THREADPOOL_QUEUE`` calls are waiting for
+  the threadpool, new requests get a 503 with Retry-After. Auth and write
+  requests are shed at half of either limit, so reads keep being served the
+  longest.
+
+Buckets live in this process by default. Set ``RATE_LIMIT_STORE`` to a file
+path to share them between the workers of one host through a small SQLite
+database; its queries run in a worker thread of their own, never on the event
+loop, and if that store is locked or broken, requests are let through rather
+than failed.
+
+Client IPs are the socket peer by default. Behind proxies that append to
+X-Forwarded-For (Railway, Render, most load balancers), set
+``RATE_LIMIT_PROXY_HOPS`` to the number of them: the client is then the
+entry that many places from the right, the one the outermost proxy added.
+Entries further left are whatever the client sent and are never trusted.
+"""
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from anyio import CapacityLimiter
+from anyio.to_thread import current_default_thread_limiter, run_sync
+from fastapi import HTTPException, status
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_AUTH_PER_MINUTE = float(os.getenv("RATE_LIMIT_AUTH_PER_MINUTE", "20"))
+RATE_LIMIT_AUTH_BURST = int(os.getenv("RATE_LIMIT_AUTH_BURST", "10"))
+RATE_LIMIT_LOGIN_ACCOUNT_PER_MINUTE = float(os.getenv("RATE_LIMIT_LOGIN_ACCOUNT_PER_MINUTE", "5"))
+RATE_LIMIT_LOGIN_ACCOUNT_BURST = int(os.getenv("RATE_LIMIT_LOGIN_ACCOUNT_BURST", "10"))
+RATE_LIMIT_WRITE_PER_MINUTE = float(os.getenv("RATE_LIMIT_WRITE_PER_MINUTE", "120"))
+RATE_LIMIT_WRITE_BURST = int(os.getenv("RATE_LIMIT_WRITE_BURST", "60"))
+# Buckets kept in memory; the least recently used are dropped beyond this
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# SQLite file shared by the workers of one host (empty: per-process buckets)
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "").strip()
+# Proxies in front of the app that append to X-Forwarded-For (0: use the socket peer)
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "0"))
+
+# 0 disables the corresponding check
+LOAD_SHED_MAX_IN_FLIGHT = int(os.getenv("LOAD_SHED_MAX_IN_FLIGHT", "256"))
+LOAD_SHED_MAX_THREADPOOL_QUEUE = int(os.getenv("LOAD_SHED_MAX_THREADPOOL_QUEUE", "64"))
+LOAD_SHED_RETRY_AFTER = int(os.getenv("LOAD_SHED_RETRY_AFTER", "1"))
+
+AUTH_PATHS = frozenset({"/auth/login", "/auth/register"})
+WRITE_METHODS = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+# Health checks, scrapes and the long-lived live feed are never limited or shed
+EXEMPT_PATHS = frozenset({"/", "/health", "/metrics", "/notice/stream"})
+
+rate_limited_total = registry.counter("rate_limited_total", "Requests rejected by a rate limit", ["rule"])
+load_shed_total = registry.counter("load_shed_total", "Requests shed because the worker was overloaded", ["reason"])
+
+
+@dataclass(frozen=True)
+class Rate:
+    name: str
+    per_minute: float
+    burst: int
+
+    @property
+    def per_second(self) -> float:
+        return self.per_minute / 60
+
+
+AUTH_RATE = Rate("auth", RATE_LIMIT_AUTH_PER_MINUTE, RATE_LIMIT_AUTH_BURST)
+LOGIN_ACCOUNT_RATE = Rate("login-account", RATE_LIMIT_LOGIN_ACCOUNT_PER_MINUTE, RATE_LIMIT_LOGIN_ACCOUNT_BURST)
+WRITE_RATE = Rate("write", RATE_LIMIT_WRITE_PER_MINUTE, RATE_LIMIT_WRITE_BURST)
+
+
+def _take(tokens: float, updated: float, rate: Rate, now: float) -> Tuple[float, float]:
+    """
+    Refill a bucket up to `now` and try to take one token. Returns the tokens
+    left and 0, or the unchanged tokens and the seconds until one is available.
+    """
+    tokens = min(float(rate.burst), tokens + (now - updated) * rate.per_second)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate.per_second
+
+
+def _full_at(tokens: float, rate: Rate, now: float) -> float:
+    # A bucket that has refilled completely is the same as no bucket at all
+    return now + (rate.burst - tokens) / rate.per_second
+
+
+class MemoryBucketStore:
+    """
+    Buckets of this process, as key -> (tokens, updated, full_at) in LRU
+    order. Only used from the event loop thread, so no locking.
+    """
+
+    blocking = False
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float, float]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key: str, rate: Rate) -> float:
+        now = time.monotonic()
+        state = self._buckets.pop(key, None)
+        tokens, updated = (state[0], state[1]) if state else (float(rate.burst), now)
+        tokens, wait = _take(tokens, updated, rate, now)
+        self._buckets[key] = (tokens, now, _full_at(tokens, rate, now))
+        self._expire(now)
+        return wait
+
+    def _expire(self, now: float):
+        # Oldest first: drop buckets that are full again, then any beyond max_keys
+        buckets = self._buckets
+        while buckets:
+            key, (_, _, full_at) = next(iter(buckets.items()))
+            if full_at > now and len(buckets) <= self.max_keys:
+                break
+            del buckets[key]
+
+
+class SqliteBucketStore:
+    """
+    Buckets in a SQLite file shared by every worker on the host. Each take is
+    one short IMMEDIATE transaction; durability is switched off since losing
+    rate limit state on a crash is harmless. take() blocks for up to the busy
+    timeout, so callers run it in a thread (see RateLimiter).
+    """
+
+    blocking = True
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = None
+        self._takes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Never reuse a connection across a fork
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=0.1, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL) "
+                "WITHOUT ROWID"
+            )
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def take(self, key: str, rate: Rate) -> float:
+        with self._lock:
+            try:
+                return self._take(key, rate)
+            except sqlite3.Error as e:
+                logger.warning(f"Rate limit store {self.path} unavailable, allowing request: {e}")
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+                return 0.0
+
+    def _take(self, key: str, rate: Rate) -> float:
+        conn = self._connection()
+        # Wall clock: the timestamps are compared across processes
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (float(rate.burst), now)
+            tokens, wait = _take(tokens, updated, rate, now)
+            conn.execute(
+                "INSERT INTO buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, "
+                "updated = excluded.updated, full_at = excluded.full_at",
+                (key, tokens, now, _full_at(tokens, rate, now)),
+            )
+            self._takes += 1
+            if self._takes % self.PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class RateLimiter:
+    def __init__(self, store, enabled: bool = RATE_LIMIT_ENABLED):
+        self.store = store
+        self.enabled = enabled
+        # Blocking stores get a thread of their own rather than the default
+        # threadpool, whose queue is what load shedding watches. Created on
+        # first use: anyio needs a running event loop for it.
+        self._thread_limiter: Optional[CapacityLimiter] = None
+
+    async def take(self, rate: Rate, key: str) -> float:
+        """
+        Spend one token from the `rate` bucket of `key`. Returns 0 when the
+        request may go ahead, otherwise the seconds to wait.
+        """
+        if not self.enabled or rate.per_minute <= 0:
+            return 0.0
+        if self.store.blocking:
+            if self._thread_limiter is None:
+                self._thread_limiter = CapacityLimiter(1)
+            wait = await run_sync(self.store.take, f"{rate.name}:{key}", rate, limiter=self._thread_limiter)
+        else:
+            wait = self.store.take(f"{rate.name}:{key}", rate)
+        if wait:
+            rate_limited_total.labels(rate.name).inc()
+        return wait
+
+
+rate_limiter = RateLimiter(SqliteBucketStore(RATE_LIMIT_STORE) if RATE_LIMIT_STORE else MemoryBucketStore())
+
+
+_warned_forwarded = False
+
+
+def client_ip(scope: Scope, proxy_hops: int = RATE_LIMIT_PROXY_HOPS) -> str:
+    """
+    Address to rate limit: the socket peer, or with `proxy_hops` proxies in
+    front, the X-Forwarded-For entry the outermost one appended
+    """
+    global _warned_forwarded
+    client = scope.get("client")
+    peer = client[0] if client else "unknown"
+    forwarded = None
+    for name, value in scope["headers"]:
+        if name == b"x-forwarded-for":
+            forwarded = value.decode("latin-1")
+            break
+    if forwarded is None:
+        return peer
+    if proxy_hops <= 0:
+        if not _warned_forwarded:
+            _warned_forwarded = True
+            logger.warning(
+                "Requests carry X-Forwarded-For but RATE_LIMIT_PROXY_HOPS is 0: "
+                "clients behind the proxy share its rate limit buckets"
+            )
+        return peer
+    hosts = [host.strip() for host in forwarded.split(",") if host.strip()]
+    # Fewer entries than proxies: only the proxy chain, no client-supplied part
+    return hosts[-proxy_hops] if len(hosts) >= proxy_hops else (hosts[0] if hosts else peer)
+
+
+def _retry_after(wait: float) -> str:
+    return str(max(1, math.ceil(wait)))
+
+
+def rate_limited_exception(wait: float):
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests, please retry later",
+        headers={"Retry-After": _retry_after(wait)},
+    )
+
+
+class RateLimitMiddleware:
+    """
+    Sheds load when the worker is saturated and applies the per-IP rate
+    limits. Sits inside CORSMiddleware so rejections still carry CORS headers.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        limiter: RateLimiter = rate_limiter,
+        max_in_flight: int = LOAD_SHED_MAX_IN_FLIGHT,
+        max_threadpool_queue: int = LOAD_SHED_MAX_THREADPOOL_QUEUE,
+    ):
+        self.app = app
+        self.limiter = limiter
+        self.max_in_flight = max_in_flight
+        self.max_threadpool_queue = max_threadpool_queue
+        self.in_flight = 0
+
+    def _overload(self, expensive: bool) -> Optional[str]:
+        # Expensive requests give way first, at half of each limit
+        divisor = 2 if expensive else 1
+        if self.max_in_flight and self.in_flight >= self.max_in_flight / divisor:
+            return "in_flight"
+        if self.max_threadpool_queue:
+            waiting = current_default_thread_limiter().statistics().tasks_waiting
+            if waiting >= self.max_threadpool_queue / divisor:
+                return "threadpool"
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        expensive = scope["method"] in WRITE_METHODS
+        reason = self._overload(expensive)
+        if reason:
+            load_shed_total.labels(reason).inc()
+            response = JSONResponse(
+                {"detail": "Server is busy, please retry shortly"},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(LOAD_SHED_RETRY_AFTER)},
+            )
+            await response(scope, receive, send)
+            return
+
+        if expensive:
+            wait = await self.limiter.take(AUTH_RATE if path in AUTH_PATHS else WRITE_RATE, client_ip(scope))
+            if wait:
+                response = JSONResponse(
+                    {"detail": "Too many requests, please retry later"},
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    headers={"Retry-After": _retry_after(wait)},
+                )
+                await response(scope, receive, send)
+                return
+
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+
+_keys_gauge = registry.gauge("rate_limit_keys", "Rate limit buckets held in this process")
+
+
+def _collect_metrics():
+    if isinstance(rate_limiter.store, MemoryBucketStore):
+        _keys_gauge.set(len(rate_limiter.store))
+
+
+registry.on_collect(_collect_metrics)
@@ -0,0 +1,107 @@
+"""
+Full-text search over notice titles and descriptions.
+
+- SQLite: an FTS5 external-content table ``notice_fts`` mirrors the notice
+  table through triggers, so inserts, updates and deletes (including the
+  batched expiry archiving) keep it in sync without any application code.
+  Results are ranked with bm25().
+- Postgres: a GIN index over the notice's tsvector; results are ranked with
+  ts_rank().
+"""
+import logging
+import re
+
+from sqlalchemy import column, func, inspect, literal_column, select, table, text
+from sqlalchemy.engine import Engine
+
+from models import Notice
+
+logger = logging.getLogger(__name__)
+
+SQLITE_FTS_INSERT_TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS notice_fts_ai AFTER INSERT ON notice BEGIN "
+    "INSERT INTO notice_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END"
+)
+SQLITE_FTS_DELETE_TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS notice_fts_ad AFTER DELETE ON notice BEGIN "
+    "INSERT INTO notice_fts(notice_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description); END"
+)
+SQLITE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE notice_fts USING fts5("
+    "title, description, content='notice', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    SQLITE_FTS_INSERT_TRIGGER,
+    SQLITE_FTS_DELETE_TRIGGER,
+    "CREATE TRIGGER IF NOT EXISTS notice_fts_au AFTER UPDATE OF title, description ON notice BEGIN "
+    "INSERT INTO notice_fts(notice_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description); "
+    "INSERT INTO notice_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+    # Index the rows that existed before search was enabled
+    "INSERT INTO notice_fts(notice_fts) VALUES ('rebuild')",
+]
+
+# Queries must repeat this exact expression for Postgres to use the index
+POSTGRES_TSVECTOR = "to_tsvector('english', coalesce(title, '') || ' ' || coalesce(description, ''))"
+POSTGRES_FTS_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_notice_fts ON notice USING GIN (({POSTGRES_TSVECTOR}))",
+]
+
+notice_fts = table("notice_fts", column("rowid"))
+
+
+def create_search_index(bind: Engine):
+    """
+    Create the full-text index for the current database if it is missing
+    """
+    with bind.begin() as conn:
+        if bind.dialect.name == "sqlite":
+            if inspect(conn).has_table("notice_fts"):
+                return
+            for statement in SQLITE_FTS_DDL:
+                conn.execute(text(statement))
+            logger.info("Created notice full-text search index (FTS5)")
+        elif bind.dialect.name == "postgresql":
+            for statement in POSTGRES_FTS_DDL:
+                conn.execute(text(statement))
+
+
+def _fts5_query(q: str) -> str:
+    # Quote every word so user input can never be parsed as FTS5 syntax;
+    # the last word is a prefix match to support search-as-you-type
+    words = re.findall(r"\w+", q)
+    terms = [f'"{word}"' for word in words]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_notices_query(dialect_name: str, q: str):
+    """
+    SELECT of notices matching `q`, best match first; None if `q` has no
+    searchable words. Callers add their own filters and LIMIT/OFFSET.
+    """
+    if dialect_name == "sqlite":
+        match = _fts5_query(q)
+        if not match:
+            return None
+        return (
+            select(Notice)
+            .join(notice_fts, notice_fts.c.rowid == Notice.id)
+            .where(literal_column("notice_fts").op("MATCH")(match))
+            .order_by(func.bm25(literal_column("notice_fts")), Notice.id.desc())
+        )
+    if dialect_name == "postgresql":
+        if not re.search(r"\w", q):
+            return None
+        vector = literal_column(POSTGRES_TSVECTOR)
+        query = func.plainto_tsquery(literal_column("'english'"), q)
+        return (
+            select(Notice)
+            .where(vector.op("@@")(query))
+            .order_by(func.ts_rank(vector, query).desc(), Notice.id.desc())
+        )
+    # Other databases: unindexed substring match
+    pattern = f"%{q}%"
+    return (
+        select(Notice)
+        .where(Notice.title.ilike(pattern) | Notice.description.ilike(pattern))
+        .order_by(Notice.post_date.desc(), Notice.id.desc())
+    )
@@ -0,0 +1,62 @@
+"""
+Opt-in fast JSON path for notice responses (FAST_JSON_RESPONSES=true).
+
+The regular path validates every row into a ``NoticeResponse`` and lets
+pydantic encode the list. The fast path takes the selected column tuples and
+encodes them straight to bytes, with orjson when it is installed and the
+standard library otherwise. Both paths produce the same JSON: same keys in
+the same order, ISO dates and times, so the OpenAPI schema (still declared
+through ``response_model``) describes either one.
+"""
+import json
+import os
+from datetime import date, time
+from typing import Iterable, Sequence
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+from models import Notice
+
+FAST_JSON_RESPONSES = os.getenv("FAST_JSON_RESPONSES", "false").lower() in ("1", "true", "yes")
+
+# Column order matches NoticeResponse's field order
+NOTICE_COLUMNS = (
+    Notice.id,
+    Notice.title,
+    Notice.description,
+    Notice.post_date,
+    Notice.event_date,
+    Notice.event_start_time,
+    Notice.event_end_time,
+    Notice.type,
+)
+NOTICE_FIELDS = tuple(column.key for column in NOTICE_COLUMNS)
+
+
+def _default(value):
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def dump_notice(row: Sequence) -> bytes:
+    """
+    One row selected with NOTICE_COLUMNS as a JSON object
+    """
+    return dumps(dict(zip(NOTICE_FIELDS, row)))
+
+
+def dump_notices(rows: Iterable[Sequence]) -> bytes:
+    """
+    Rows selected with NOTICE_COLUMNS as a JSON array of objects
+    """
+    return dumps([dict(zip(NOTICE_FIELDS, row)) for row in rows])